@@ -3,7 +3,8 @@
 import os, shutil, sys
 from argparse import ArgumentParser
 
-from fbreader.opds import ErrorHandler, OpdsBuilder
+from fbreader.format.util import Verification
+from fbreader.opds import CoverStore, ErrorHandler, OpdsBuilder
 
 def parse_command_line():
     parser = ArgumentParser(
@@ -27,7 +28,69 @@ def parse_command_line():
         default=False,
         help='override existing OPDS directory'
     )
+    parser.add_argument(
+        '-j',
+        metavar='workers',
+        dest='workers',
+        type=int,
+        default=1,
+        help='number of books to process in parallel (default = 1)'
+    )
+    parser.add_argument(
+        '-d',
+        metavar='downloads',
+        dest='downloads',
+        type=int,
+        default=4,
+        help='number of books to download in parallel, ahead of processing (default = 4, 0 means books are downloaded by processing workers)'
+    )
+    parser.add_argument(
+        '--connections-per-host',
+        metavar='connections',
+        dest='connections_per_host',
+        type=int,
+        default=2,
+        help='maximum number of simultaneous downloads from a host (default = 2)'
+    )
+    parser.add_argument(
+        '-p',
+        metavar='page_size',
+        dest='page_size',
+        type=int,
+        default=0,
+        help='split catalog into pages of given number of books (default = 0, no pagination)'
+    )
+    parser.add_argument(
+        '--verify',
+        dest='verification',
+        choices=Verification.ALL,
+        default=Verification.FULL,
+        help='zip archive check level: lazy (entries are checked when read), central-directory (no decompression), full (default, all entries are checked)'
+    )
+    parser.add_argument(
+        '-i',
+        dest='incremental',
+        action='store_true',
+        default=False,
+        help='update existing OPDS directory, process only books changed since the previous run'
+    )
+    parser.add_argument(
+        '-c',
+        metavar='cover_store_dir',
+        dest='cover_store',
+        help='directory of the cover store shared between catalogs; covers of books already processed for any catalog are linked, not re-created'
+    )
+    parser.add_argument(
+        '--cover-store-limit',
+        metavar='megabytes',
+        dest='cover_store_limit',
+        type=int,
+        default=0,
+        help='cover store size limit, least recently used covers are removed (default = 0, no limit)'
+    )
     params = parser.parse_args(sys.argv[1:])
+    if params.page_size < 0:
+        parser.error('-p must not be negative')
     return params
 
 class CommandLineErrorHandler(ErrorHandler):
@@ -44,9 +107,20 @@ if __name__ == '__main__':
     if os.path.exists(params.output_dir):
         if params.override:
             shutil.rmtree(params.output_dir)
-        else:
+        elif not params.incremental:
             error_handler.fatal('%s already exists', params.output_dir)
-    os.makedirs(params.output_dir)
+    if not os.path.exists(params.output_dir):
+        os.makedirs(params.output_dir)
 
-    builder = OpdsBuilder(output_dir=params.output_dir, error_handler=error_handler)
+    builder = OpdsBuilder(
+        output_dir=params.output_dir,
+        error_handler=error_handler,
+        workers=params.workers,
+        incremental=params.incremental,
+        page_size=params.page_size,
+        verification=params.verification,
+        downloads=params.downloads,
+        connections_per_host=params.connections_per_host,
+        cover_store=CoverStore(params.cover_store, params.cover_store_limit * 1024 * 1024) if params.cover_store else None
+    )
     builder.build(params.description_file)
@@ -3,6 +3,7 @@
 import shutil, string, sys, tempfile
 from argparse import ArgumentParser
 
+from fbreader.format.batch import encrypt_books, read_manifest
 from fbreader.format.epub import EPub
 
 def verify_key(key, name):
@@ -28,29 +29,81 @@ def parse_command_line():
         '-k',
         dest='key',
         metavar='key',
-        required=True,
         help='encryption key (32-digit hex number)'
     )
     parser.add_argument(
         '-ci',
         dest='content_id',
         metavar='content_id',
-        required=True,
         help='content id'
     )
+    parser.add_argument(
+        '-j',
+        metavar='workers',
+        dest='workers',
+        type=int,
+        default=1,
+        help='number of entries (or books, in manifest mode) to encrypt in parallel (default = 1)'
+    )
+    parser.add_argument(
+        '-m',
+        '--manifest',
+        dest='manifest',
+        metavar='manifest',
+        help='CSV (columns epub, content_id, key, keep) or JSON Lines file listing books to encrypt'
+    )
+    parser.add_argument(
+        '--journal',
+        dest='journal',
+        metavar='journal',
+        help='manifest mode status file, books listed there as done are skipped (default = <manifest>.journal)'
+    )
     parser.add_argument(
         'epub',
+        nargs='?',
         help='name of ePub file to encrypt'
     )
     params = parser.parse_args(sys.argv[1:])
-    verify_key(params.key, 'key')
+    if params.workers < 1:
+        parser.error('-j must be at least 1')
+    if params.manifest:
+        if params.epub or params.key or params.content_id or params.keep_unencrypted is not None:
+            parser.error('epub, -k, -ci and -s cannot be used with manifest (use its keep column)')
+        if not params.journal:
+            params.journal = params.manifest + '.journal'
+    else:
+        if not params.epub or not params.key or not params.content_id:
+            parser.error('epub, -k and -ci are required')
+        verify_key(params.key, 'key')
     return params
 
+def encrypt_manifest(params):
+    failed = 0
+    tasks = []
+    for task in read_manifest(params.manifest):
+        try:
+            verify_key(task[2], 'key')
+            tasks.append(task)
+        except Exception, error:
+            failed += 1
+            print 'error %s: %s' % (task[0], error)
+    for record in encrypt_books(tasks, params.journal, workers=params.workers):
+        if record['status'] == 'error':
+            failed += 1
+            print '%s %s (%.3fs): %s' % (record['status'], record['epub'], record['seconds'], record['error'])
+        else:
+            print '%s %s (%.3fs)' % (record['status'], record['epub'], record['seconds'])
+    if failed:
+        exit('%d book(s) failed' % failed)
+
 if __name__ == '__main__':
     params = parse_command_line()
+    if params.manifest:
+        encrypt_manifest(params)
+        exit()
     working_dir = tempfile.mkdtemp(dir='.')
     try:
         epub = EPub(params.epub, params.epub)
-        epub.encrypt(params.key, params.content_id, working_dir, files_to_keep=params.keep_unencrypted)
+        epub.encrypt(params.key, params.content_id, working_dir, files_to_keep=params.keep_unencrypted, workers=params.workers)
     finally:
         shutil.rmtree(working_dir)
@@ -1,9 +1,10 @@
-import magic, zipfile
+import zipfile
 from xml import sax
 
 from fbreader.format.mimetype import Mimetype
+from fbreader.format.signature import detect_by_signature, HEAD_SIZE
 
-from fbreader.format.util import list_zip_file_infos
+from fbreader.format.util import list_zip_file_infos, verify_zip_file, Detection, Verification
 from fbreader.format.epub import EPub
 from fbreader.format.fb2 import FB2, FB2Zip
 #from fbreader.format.pdf import PDF
@@ -13,54 +14,79 @@ from fbreader.format.mobi import Mobipocket
 #from fbreader.format.djvu import DjVu
 #from fbreader.format.dummy import Dummy
 
-__detector = magic.open(magic.MAGIC_MIME_TYPE)
-__detector.load()
+# libmagic detector, loaded on first use; it is needed only for
+# files not recognized by detect_by_signature
+__detector = None
 
-def detect_mime(filename):
+def detect_mime(filename, verification=Verification.FULL):
+    detection = detect(filename, verification)
+    detection.close()
+    return detection.mimetype
+
+def detect(filename, verification=Verification.FULL):
+    '''
+    returns Detection object; pass it to book class constructor
+    or close it
+    '''
     FB2_ROOT = 'FictionBook'
 
-    mime = __detector.file(filename)
+    with open(filename, 'rb') as f:
+        mime = detect_by_signature(f.read(HEAD_SIZE))
+    if not mime:
+        mime = __magic_mime(filename)
 
+    zip_file = None
     try:
         if mime == Mimetype.XML:
             if FB2_ROOT == __xml_root_tag(filename):
-                return Mimetype.FB2
+                return Detection(Mimetype.FB2)
         elif mime == Mimetype.ZIP:
-            with zipfile.ZipFile(filename) as zip_file:
-                if not zip_file.testzip():
-                    infolist = list_zip_file_infos(zip_file)
-                    if len(infolist) == 1:
-                        if FB2_ROOT == __xml_root_tag(zip_file.open(infolist[0])):
-                            return Mimetype.FB2_ZIP
-                    try:
-                        with zip_file.open('mimetype') as mimetype_file:
-                            if mimetype_file.read(30).rstrip('\n\r') == Mimetype.EPUB:
-                                return Mimetype.EPUB
-                    except:
-                        pass
+            zip_file = zipfile.ZipFile(filename)
+            if not verify_zip_file(zip_file, verification):
+                infolist = list_zip_file_infos(zip_file)
+                if len(infolist) == 1:
+                    with zip_file.open(infolist[0]) as entry:
+                        root_tag = __xml_root_tag(entry)
+                    if FB2_ROOT == root_tag:
+                        return Detection(Mimetype.FB2_ZIP, zip_file, infolist)
+                try:
+                    with zip_file.open('mimetype') as mimetype_file:
+                        if mimetype_file.read(30).rstrip('\n\r') == Mimetype.EPUB:
+                            return Detection(Mimetype.EPUB, zip_file, infolist)
+                except:
+                    pass
         elif mime == Mimetype.OCTET_STREAM:
             with open(filename, 'rb') as f:
                 if f.read(68)[60:] == 'BOOKMOBI':
-                    return Mimetype.MOBI
+                    return Detection(Mimetype.MOBI)
     except:
         pass
-        
-    return mime
 
-def create_bookfile(path, original_filename):
-    mimetype = detect_mime(path)
+    if zip_file:
+        zip_file.close()
+    return Detection(mime)
+
+def create_bookfile(path, original_filename, verification=Verification.FULL, lazy=False):
+    '''
+    verification:   zip archive check level, see util.Verification;
+                    use BookFile.validate() for a full check later
+    lazy:           metadata fields are extracted on first access,
+                    not in the constructor (EPub, FB2 and Mobipocket)
+    '''
+    detection = detect(path, verification)
+    mimetype = detection.mimetype
     if mimetype == Mimetype.EPUB:
-        return EPub(path, original_filename)
+        return EPub(path, original_filename, verification, detection, lazy)
     elif mimetype == Mimetype.FB2:
-        return FB2(path, original_filename)
+        return FB2(path, original_filename, lazy)
     elif mimetype == Mimetype.FB2_ZIP:
-        return FB2Zip(path, original_filename)
+        return FB2Zip(path, original_filename, verification, detection, lazy)
     elif mimetype == Mimetype.PDF:
         return PDF(path, original_filename)
     elif mimetype == Mimetype.MSWORD:
         return MSWord(path, original_filename)
     elif mimetype == Mimetype.MOBI:
-        return Mobipocket(path, original_filename)
+        return Mobipocket(path, original_filename, lazy)
     elif mimetype == Mimetype.RTF:
         return RTF(path, original_filename)
     elif mimetype == Mimetype.DJVU:
@@ -68,8 +94,20 @@ def create_bookfile(path, original_filename):
     elif mimetype in [Mimetype.TEXT]:
         return Dummy(path, original_filename, mimetype)
     else:
+        detection.close()
         raise Exception('File type \'%s\' is not supported, sorry' % mimetype)
 
+def __magic_mime(filename):
+    global __detector
+    try:
+        if __detector is None:
+            import magic
+            __detector = magic.open(magic.MAGIC_MIME_TYPE)
+            __detector.load()
+        return __detector.file(filename)
+    except:
+        return Mimetype.OCTET_STREAM
+
 def __xml_root_tag(filename):
     class XMLRootFound(Exception):
         def __init__(self, name):
@@ -1,33 +1,80 @@
-import gzip, os
+import gzip, os, shutil, tempfile
 from Crypto.Cipher import AES
-from tempfile import mktemp
 
-def encrypt(file_name, key, working_dir):
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+class CBCWriter(object):
+    '''
+    Write-only file-like object: encrypts data written to it
+    with AES-CBC (PKCS#7 padding is added on close) and passes
+    the result to the underlying stream.
+    '''
+    def __init__(self, ostream, key, init_vector, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.__ostream = ostream
+        self.__encryptor = AES.new(key, AES.MODE_CBC, init_vector)
+        self.__chunk_size = max(chunk_size - chunk_size % AES.block_size, AES.block_size)
+        self.__buffer = []
+        self.__buffered = 0
+
+    def write(self, data):
+        self.__buffer.append(data)
+        self.__buffered += len(data)
+        if self.__buffered >= self.__chunk_size:
+            data = ''.join(self.__buffer)
+            size = len(data) - len(data) % AES.block_size
+            self.__ostream.write(self.__encryptor.encrypt(data[:size]))
+            self.__buffer = [data[size:]]
+            self.__buffered = len(data) - size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        data = ''.join(self.__buffer)
+        pad = AES.block_size - len(data) % AES.block_size
+        self.__ostream.write(self.__encryptor.encrypt(data + pad * chr(pad)))
+        self.__buffer = []
+        self.__buffered = 0
+
+def encrypt_stream(istream, ostream, key, init_vector=None, chunk_size=DEFAULT_CHUNK_SIZE, mtime=None):
+    '''
+    istream:       file-like object to read plain data from
+    ostream:       file-like object to write encrypted data to
+    key:           16 byte string
+    init_vector:   16 byte string (random if not specified)
+    chunk_size:    size of blocks to read and encrypt
+    mtime:         timestamp for gzip header (current time if not specified)
+
+    Writes init vector followed by AES-CBC encrypted gzip stream,
+    in a single pass, no temporary files are used.
+    '''
+    if init_vector is None:
+        init_vector = os.urandom(16)
+    ostream.write(init_vector)
+
+    writer = CBCWriter(ostream, key, init_vector, chunk_size)
+    with gzip.GzipFile(filename='', mode='wb', fileobj=writer, mtime=mtime) as compressor:
+        while True:
+            data = istream.read(chunk_size)
+            if not data:
+                break
+            compressor.write(data)
+    writer.close()
+
+def encrypt(file_name, key, working_dir=None, chunk_size=DEFAULT_CHUNK_SIZE):
     '''
     file_name:     full path to file to encrypt
     key:           16 byte string
-    working_dir:   directory to create temorary files
+    working_dir:   directory to create temporary file
+                   (directory of the file if not specified)
+    chunk_size:    size of blocks to read and encrypt
     '''
-    tmp_file_name = mktemp(dir=working_dir)
-    with open(file_name, 'rb') as istream:
-        with gzip.open(tmp_file_name, 'wb') as ostream:
-            ostream.writelines(istream)
-
-    init_vector = os.urandom(16)
-
-    mode = AES.MODE_CBC
-    encryptor = AES.new(key, mode, init_vector)
-
-    with open(tmp_file_name, 'rb') as istream:
-        with open(file_name, 'wb') as ostream:
-            ostream.write(init_vector)
-            while True:
-                data = istream.read(8192)
-                if len(data) == 8192:
-                    ostream.write(encryptor.encrypt(data))
-                else:
-                    pad = 16 - len(data) % 16
-                    ostream.write(encryptor.encrypt(data + pad * chr(pad)))
-                    break
-
-    os.remove(tmp_file_name)
+    handle, tmp_file_name = tempfile.mkstemp(dir=working_dir or os.path.dirname(file_name))
+    try:
+        with os.fdopen(handle, 'wb') as ostream:
+            with open(file_name, 'rb') as istream:
+                encrypt_stream(istream, ostream, key, chunk_size=chunk_size)
+        shutil.move(tmp_file_name, file_name)
+    except:
+        os.remove(tmp_file_name)
+        raise
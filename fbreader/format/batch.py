@@ -0,0 +1,174 @@
+import csv, itertools, json, multiprocessing, os, shutil, sys, tempfile, time
+
+from fbreader.format import create_bookfile
+from fbreader.format.epub import EPub
+from fbreader.format.util import Verification
+
+def scan_file(task):
+    '''
+    task:   (path, root directory, verification level) tuple;
+            module-level function to be usable with multiprocessing pools
+    returns metadata record (dict) for the file; records for files
+    that cannot be parsed contain 'error' key; byte strings (e.g. title
+    taken from the file name) are decoded, so the record can be
+    serialized to JSON whatever the file name encoding is
+    '''
+    path, root, verification = task
+    record = {
+        'path': os.path.relpath(path, root)
+    }
+    try:
+        with create_bookfile(path, os.path.basename(path), verification) as book:
+            record.update({
+                'mimetype': book.mimetype,
+                'title': book.title,
+                'authors': book.authors,
+                'tags': book.tags,
+                'series': book.series_info,
+                'language': book.language_code,
+                'encryption': book.get_encryption_info(),
+                'issues': book.issues
+            })
+    except Exception, error:
+        try:
+            record['error'] = str(error)
+        except UnicodeError:
+            record['error'] = unicode(error)
+    return __unicode(record)
+
+def scan_directory(root, workers=1, verification=Verification.FULL):
+    '''
+    root:           directory to scan recursively
+    workers:        number of processes used for parsing; 1 means
+                    all the files are parsed in the calling process
+    verification:   zip archive check level, see util.Verification
+    generates metadata records (see scan_file) in directory walk order
+    '''
+    tasks = ((path, root, verification) for path in __list_files(root))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for record in pool.imap(scan_file, tasks, chunksize=16):
+                yield record
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for record in itertools.imap(scan_file, tasks):
+            yield record
+
+def read_manifest(path):
+    '''
+    path:   CSV file with header row (columns epub, content_id, key, keep;
+            keep is a space-separated list of entries to keep unencrypted)
+            or JSON Lines file (*.jsonl, *.json; objects with the same keys,
+            keep is a list)
+    generates (epub, content_id, key, files_to_keep) tuples
+    '''
+    with open(path) as istream:
+        if path.endswith('.jsonl') or path.endswith('.json'):
+            rows = (json.loads(line) for line in istream if line.strip())
+        else:
+            rows = csv.DictReader(istream)
+        for row in rows:
+            keep = row.get('keep') or None
+            if isinstance(keep, basestring):
+                keep = keep.split() or None
+            yield (row['epub'], row['content_id'], row['key'], keep)
+
+def encrypt_book(task):
+    '''
+    task:   (epub, content_id, key, files_to_keep) tuple; module-level
+            function to be usable with multiprocessing pools
+    returns status record: epub, content_id, status ('ok', 'skipped' if
+    the book is already encrypted with the content id, 'error'),
+    error message (for failed books), seconds
+    '''
+    epub_path, content_id, key, files_to_keep = task
+    start = time.time()
+    record = {
+        'epub': epub_path,
+        'content_id': content_id
+    }
+    try:
+        # working directory on the same file system, so the encrypted
+        # archive replaces the original one by an atomic rename
+        working_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(epub_path)))
+        try:
+            with EPub(epub_path, epub_path) as epub:
+                info = epub.get_encryption_info()
+                if info.get('method') == 'marlin' and content_id in info.get('content_ids', []):
+                    record['status'] = 'skipped'
+                else:
+                    epub.encrypt(key, content_id, working_dir, files_to_keep=files_to_keep)
+                    record['status'] = 'ok'
+        finally:
+            shutil.rmtree(working_dir)
+    except Exception, error:
+        record['status'] = 'error'
+        record['error'] = str(error)
+    record['seconds'] = round(time.time() - start, 3)
+    return record
+
+def encrypt_books(tasks, journal_path, workers=1):
+    '''
+    tasks:          iterable of encrypt_book tasks
+    journal_path:   JSON Lines file with status records of the previous runs;
+                    books finished successfully are not processed again,
+                    new records are appended as soon as books are done
+    workers:        number of books processed in parallel
+    generates status records (see encrypt_book) in completion order
+    '''
+    done = set()
+    if os.path.exists(journal_path):
+        with open(journal_path) as istream:
+            for line in istream:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line can be incomplete after a crash
+                    continue
+                if record.get('status') in ('ok', 'skipped'):
+                    done.add(record['epub'])
+    tasks = [task for task in tasks if not task[0] in done]
+
+    with open(journal_path, 'a') as journal:
+        if workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(encrypt_book, tasks)
+        else:
+            pool = None
+            results = itertools.imap(encrypt_book, tasks)
+        try:
+            for record in results:
+                journal.write(json.dumps(record, sort_keys=True) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+                yield record
+            if pool:
+                pool.close()
+        except:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.join()
+
+def __list_files(root):
+    for directory, subdirs, files in os.walk(root):
+        subdirs.sort()
+        for name in sorted(files):
+            yield os.path.join(directory, name)
+
+def __unicode(value):
+    if isinstance(value, str):
+        return value.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict((__unicode(k), __unicode(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [__unicode(v) for v in value]
+    return value
@@ -1,15 +1,50 @@
 import os, re
 from abc import abstractmethod, ABCMeta
 
+from fbreader.format.cover import CoverImage
+from fbreader.format.record import BookRecord
 from fbreader.format.util import minify_cover
 
+class MetadataGroup(object):
+    # title, authors, tags, series info, language
+    HEADER = 'header'
+    DESCRIPTION = 'description'
+    # cover file discovery (format-specific attributes)
+    COVER = 'cover'
+
+    ALL = (HEADER, DESCRIPTION, COVER)
+
+def metadata_property(name, group):
+    '''
+    BookFile attribute extracted with the given group of fields;
+    in lazy mode, the group is extracted on the first access
+    '''
+    key = '_metadata_' + name
+
+    def get(book):
+        book.__require__(group)
+        return getattr(book, key)
+
+    def set(book, value):
+        setattr(book, key, value)
+
+    return property(get, set)
+
 class BookFile(object):
     __metaclass__ = ABCMeta
 
+    title = metadata_property('title', MetadataGroup.HEADER)
+    authors = metadata_property('authors', MetadataGroup.HEADER)
+    tags = metadata_property('tags', MetadataGroup.HEADER)
+    series_info = metadata_property('series_info', MetadataGroup.HEADER)
+    language_code = metadata_property('language_code', MetadataGroup.HEADER)
+    description = metadata_property('description', MetadataGroup.DESCRIPTION)
+
     def __init__(self, path, original_filename, mimetype):
         self.path = path
         self.mimetype = mimetype
         self.original_filename = original_filename
+        self.__pending = set(MetadataGroup.ALL)
         self.title = original_filename
         self.description = None
         self.authors = []
@@ -25,6 +60,23 @@ class BookFile(object):
     def __exit__(self, kind, value, traceback):
         pass
 
+    def __load_metadata__(self, group):
+        '''
+        group:  MetadataGroup value
+        extracts fields of the group; is called once per group, either
+        by __load_all_metadata__ or (in lazy mode) on the first access
+        '''
+        pass
+
+    def __require__(self, group):
+        if group in self.__pending:
+            self.__pending.remove(group)
+            self.__load_metadata__(group)
+
+    def __load_all_metadata__(self):
+        for group in MetadataGroup.ALL:
+            self.__require__(group)
+
     def extract_cover(self, working_dir):
         cover, minified = self.extract_cover_internal(working_dir)
         if cover and not minified:
@@ -32,7 +84,26 @@ class BookFile(object):
         return cover
 
     def extract_cover_internal(self, working_dir):
-        return (None, False)
+        data = self.extract_cover_data()
+        if not data:
+            return (None, False)
+        with open(os.path.join(working_dir, 'cover'), 'wb') as cover_file:
+            cover_file.write(data)
+        return ('cover', False)
+
+    def extract_cover_data(self):
+        '''
+        returns cover image file content (string) or None
+        '''
+        return None
+
+    def extract_cover_image(self):
+        '''
+        returns CoverImage (decoded and minified in memory), or None
+        if there is no cover or it cannot be decoded
+        '''
+        data = self.extract_cover_data()
+        return CoverImage.decode(data) if data else None
 
     @staticmethod
     def __is_text(text):
@@ -72,5 +143,19 @@ class BookFile(object):
     def get_encryption_info(self):
         return {}
 
+    def to_record(self):
+        '''
+        returns BookRecord with the metadata; the record does not refer
+        to the book object, so the book can be closed and released
+        '''
+        return BookRecord.from_book(self)
+
+    def validate(self):
+        '''
+        full integrity check (e.g., CRC of every zip entry),
+        raises an exception if the file is broken
+        '''
+        pass
+
     def repair(self, working_dir):
         pass
@@ -0,0 +1,214 @@
+import hashlib, io, os, pickle, subprocess, sys, threading
+import PythonMagick
+from abc import abstractmethod, ABCMeta
+from PIL import Image, ImageFile
+
+# covers of more pixels are rejected before decoding
+MAX_PIXELS = 40 * 1000 * 1000
+
+class CoverDecoder(object):
+    '''
+    Decoder of cover image data. Decoders are tried in the registration
+    order, see CoverImage.register_decoder(). A decoder returns either
+    loaded PIL image, or the data converted to another format (string);
+    converted data is passed to all the registered decoders again, in memory.
+    '''
+    __metaclass__ = ABCMeta
+
+    # seconds; decoder with a timeout is run in a separate Python process
+    # (not forked from the caller, which may have threads running), killed
+    # if it does not finish in time; such decoder must be picklable and
+    # must return converted data
+    TIMEOUT = None
+
+    def accepts(self, data):
+        '''
+        data:   encoded image (string)
+        returns False if the decoder must not be tried for the data
+        '''
+        return True
+
+    @abstractmethod
+    def decode(self, data):
+        '''
+        raises exception if the data cannot be decoded
+        or the image has more than MAX_PIXELS pixels
+        '''
+        pass
+
+class PILDecoder(CoverDecoder):
+    def decode(self, data):
+        image = Image.open(io.BytesIO(data))
+        if image.format == 'JPEG' and image.size[0] > CoverImage.MAX_WIDTH:
+            # DCT scaling: decoder produces image reduced by 2, 4 or 8,
+            # still not smaller than the cover size; the cover size is
+            # computed from the original one
+            width, height = image.size
+            # at least one row for very wide images
+            image.draft('RGB', (CoverImage.WIDTH, max(1, CoverImage.WIDTH * height // width)))
+            image.info['original_size'] = (width, height)
+        # size is known from the header, pixels are not decoded yet
+        if image.size[0] * image.size[1] > MAX_PIXELS:
+            raise Exception('Cover image is too large: %sx%s' % image.size)
+        image.load()
+        return image
+
+class MagickDecoder(CoverDecoder):
+    '''
+    Formats PIL does not support (SVG, some TIFFs, etc.),
+    converted to PNG
+    '''
+    TIMEOUT = 10
+
+    def decode(self, data):
+        blob = PythonMagick.Blob(data)
+        image = PythonMagick.Image()
+        # reads image attributes, pixels are not decoded
+        image.ping(blob)
+        if image.size().width() * image.size().height() > MAX_PIXELS:
+            raise Exception('Cover image is too large')
+        image.read(blob)
+        image.magick('PNG')
+        blob = PythonMagick.Blob()
+        image.write(blob)
+        return blob.data
+
+class CoverImage(object):
+    '''
+    Cover image decoded once and kept in memory; minified cover
+    and thumbnail are encoded from the same decoded image.
+    '''
+    # wider images are scaled down to WIDTH
+    MAX_WIDTH = 600
+    WIDTH = 500
+    # maximum number of format conversions while decoding
+    MAX_CONVERSIONS = 3
+
+    def __init__(self, image, original_size=None):
+        '''
+        image:          PIL image, RGB mode
+        original_size:  size of the encoded image, if the image
+                        was reduced while decoding
+        '''
+        self.image = image
+        width, height = original_size or image.size
+        if width > CoverImage.MAX_WIDTH:
+            height = int(float(CoverImage.WIDTH) * height / width)
+            self.image = CoverImage.__scale(image, (CoverImage.WIDTH, height))
+
+    @staticmethod
+    def __scale(image, size):
+        '''
+        staged resize: cheap box filter reduces the image by integer factor
+        down to at most twice the target size, antialiasing filter is
+        applied to the final step only
+        '''
+        width, height = size
+        factor = min(image.size[0] // (2 * width), image.size[1] // (2 * max(height, 1)))
+        if factor > 1:
+            image = image.resize((image.size[0] // factor, image.size[1] // factor), Image.BOX)
+        return image.resize((width, max(height, 1)), Image.ANTIALIAS)
+
+    __decoders = [PILDecoder(), MagickDecoder()]
+
+    @staticmethod
+    def register_decoder(decoder, first=True):
+        '''
+        decoder:    CoverDecoder instance
+        first:      try the decoder before already registered ones
+        '''
+        if first:
+            CoverImage.__decoders.insert(0, decoder)
+        else:
+            CoverImage.__decoders.append(decoder)
+
+    @staticmethod
+    def decode(data):
+        '''
+        data:   encoded image (string)
+        returns CoverImage, or None if the data cannot be decoded
+        '''
+        # (decoder, data hash) pairs, protects from conversion loops
+        tried = set()
+        for count in range(CoverImage.MAX_CONVERSIONS + 1):
+            digest = hashlib.sha1(data).digest()
+            for decoder in CoverImage.__decoders:
+                if (decoder, digest) in tried or not decoder.accepts(data):
+                    continue
+                tried.add((decoder, digest))
+                try:
+                    result = CoverImage.__run(decoder, data)
+                except:
+                    continue
+                if isinstance(result, str):
+                    # converted data is passed to all the decoders
+                    data = result
+                    break
+                try:
+                    return CoverImage(result.convert('RGB'), result.info.get('original_size'))
+                except:
+                    return None
+            else:
+                return None
+        return None
+
+    @staticmethod
+    def __run(decoder, data):
+        if decoder.TIMEOUT is None:
+            return decoder.decode(data)
+
+        # a crash, hang or memory blowup in the decoder cannot affect
+        # the caller; the child process runs this module as a script
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(os.path.abspath(p) for p in sys.path))
+        with open(os.devnull, 'wb') as devnull:
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'fbreader.format.cover'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull,
+                close_fds=True, env=env
+            )
+        def kill():
+            try:
+                process.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(decoder.TIMEOUT, kill)
+        timer.start()
+        try:
+            result = process.communicate(pickle.dumps((decoder, data, MAX_PIXELS), pickle.HIGHEST_PROTOCOL))[0]
+        finally:
+            timer.cancel()
+        if process.returncode != 0:
+            raise Exception('Cover decoding failed or timed out')
+        return result
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def jpeg(self):
+        '''
+        returns minified cover encoded as progressive JPEG
+        '''
+        ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK, self.image.size[0] * self.image.size[1])
+        ostream = io.BytesIO()
+        self.image.save(ostream, 'JPEG', optimize=True, progressive=True)
+        return ostream.getvalue()
+
+    def thumbnail_jpeg(self, width):
+        '''
+        returns thumbnail of given width encoded as JPEG; it is scaled
+        from the already reduced cover image
+        '''
+        thumbnail = self.image
+        if thumbnail.size[0] > width:
+            height = int(float(width) * thumbnail.size[1] / thumbnail.size[0] + .5)
+            thumbnail = CoverImage.__scale(thumbnail, (width, height))
+        ostream = io.BytesIO()
+        thumbnail.save(ostream, 'JPEG')
+        return ostream.getvalue()
+
+if __name__ == '__main__':
+    # decoder process, see CoverImage.__run
+    from fbreader.format import cover
+    decoder, data, cover.MAX_PIXELS = pickle.load(sys.stdin)
+    sys.stdout.write(decoder.decode(data))
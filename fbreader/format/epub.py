@@ -1,11 +1,12 @@
-import os, shutil, urllib, zipfile
+import itertools, os, shutil, urllib, zipfile
 from lxml import etree
-from tempfile import mktemp
+from multiprocessing.pool import ThreadPool
+from tempfile import mktemp, SpooledTemporaryFile
 
-from fbreader.format.aes import encrypt
-from fbreader.format.bookfile import BookFile
+from fbreader.format.aes import encrypt_stream
+from fbreader.format.bookfile import BookFile, MetadataGroup, metadata_property
 from fbreader.format.mimetype import Mimetype
-from fbreader.format.util import list_zip_file_infos
+from fbreader.format.util import copy_zip_entry, list_zip_file_infos, store_entry_first, verify_zip_file, write_stored_entry, ChecksumWriter, Verification
 
 class EPub(BookFile):
     class Issue(object):
@@ -37,23 +38,47 @@ class EPub(BookFile):
     ALGORITHM_EMBEDDING = 'http://www.idpf.org/2008/embedding'
     ALGORITHM_AES128 = Namespace.ENCRYPTION + 'aes128-cbc'
 
+    # encryption: total size of entries processed in one batch,
+    # and size of encrypted entry data kept in memory (rest goes to disk)
+    ENCRYPTION_BATCH_SIZE = 32 * 1024 * 1024
+    ENCRYPTION_SPOOL_SIZE = 1024 * 1024
+
     class StructureException(Exception):
         def __init__(self, message):
             Exception.__init__(self, 'ePub verification failed: ' + message)
 
-    def __init__(self, path, original_filename):
+    root_filename = metadata_property('root_filename', MetadataGroup.HEADER)
+    cover_fileinfos = metadata_property('cover_fileinfos', MetadataGroup.COVER)
+
+    def __init__(self, path, original_filename, verification=Verification.FULL, detection=None, lazy=False):
+        '''
+        detection:  Detection object for the file; its open archive
+                    is used instead of opening and verifying it again
+        lazy:       do not parse OPF in constructor, metadata fields
+                    are extracted on first access
+        '''
         BookFile.__init__(self, path, original_filename, Mimetype.EPUB)
         self.root_filename = None
         self.cover_fileinfos = []
 
+        self.__verification = verification
         self.__zip_file = None
-        self.__initialize()
+        self.__initialize(detection)
+        if not lazy:
+            try:
+                self.__load_all_metadata__()
+            except:
+                self.close()
+                raise
 
-    def __initialize(self):
-        self.__zip_file = zipfile.ZipFile(self.path)
+    def __initialize(self, detection=None):
+        detected = detection is not None and detection.zip_file is not None
+        self.__zip_file = detection.zip_file if detected else zipfile.ZipFile(self.path)
         self.issues = []
+        self.__meta_trees = {}
+        self.__opf = None
         try:
-            if self.__zip_file.testzip():
+            if not detected and verify_zip_file(self.__zip_file, self.__verification):
                 raise EPub.StructureException('broken zip archive')
 
             infos = self.__zip_file.infolist()
@@ -66,11 +91,10 @@ class EPub(BookFile):
             elif mimetype_info.compress_type != zipfile.ZIP_STORED:
                 self.issues.append(EPub.Issue.MIMETYPE_ITEM_IS_DEFLATED)
 
-            with self.__zip_file.open(EPub.Entry.MIMETYPE) as mimetype_file:
-                if mimetype_file.read(30).rstrip('\n\r') != Mimetype.EPUB:
-                    raise EPub.StructureException('\'mimetype\' item content is incorrect')
-
-            self.__extract_metainfo()
+            if not detected:
+                with self.__zip_file.open(EPub.Entry.MIMETYPE) as mimetype_file:
+                    if mimetype_file.read(30).rstrip('\n\r') != Mimetype.EPUB:
+                        raise EPub.StructureException('\'mimetype\' item content is incorrect')
         except EPub.StructureException, error:
             self.close()
             raise error
@@ -81,69 +105,100 @@ class EPub(BookFile):
     def close(self):
         self.__zip_file.close()
 
+    def validate(self):
+        try:
+            broken = self.__zip_file.testzip()
+        except:
+            broken = True
+        if broken:
+            raise EPub.StructureException('broken zip archive')
+
     def __exit__(self, kind, value, traceback):
         self.__zip_file.__exit__(kind, value, traceback)
 
     def __etree_from_entry(self, info):
+        '''
+        info:   ZipInfo or entry name
+        parses the entry reading it from the archive chunk by chunk
+        '''
         with self.__zip_file.open(info) as entry:
             try:
-                return etree.fromstring(entry.read(1048576))
+                return etree.parse(entry).getroot()
             except:
-                raise EPub.StructureException('\'' + info.filename + '\' is not a valid XML')
+                name = info.filename if isinstance(info, zipfile.ZipInfo) else info
+                raise EPub.StructureException('\'' + name + '\' is not a valid XML')
+
+    def __meta_etree(self, name):
+        '''
+        name:   META-INF entry name (container, encryption or rights)
+        parses the entry once per archive, subsequent calls return
+        the same (not to be modified) tree
+        '''
+        if not name in self.__meta_trees:
+            self.__meta_trees[name] = self.__etree_from_entry(name)
+        return self.__meta_trees[name]
+
+    def __opf_tree(self):
+        '''
+        returns (OPF ZipInfo, parsed OPF); OPF is parsed once per archive
+        '''
+        if self.__opf is None:
+            root_info = self.__get_root_info()
+            self.__opf = (root_info, self.__etree_from_entry(root_info))
+        return self.__opf
+
+    def __load_metadata__(self, group):
+        try:
+            root_info, tree = self.__opf_tree()
+            if group == MetadataGroup.HEADER:
+                self.__extract_metainfo(root_info, tree)
+            elif group == MetadataGroup.DESCRIPTION:
+                res = XPath.DESCRIPTION(tree)
+                if len(res) > 0 and res[0].text:
+                    self.description = res[0].text.strip()
+            elif group == MetadataGroup.COVER:
+                prefix = os.path.dirname(root_info.filename)
+                if prefix:
+                    prefix += '/'
+                self.cover_fileinfos = self.__find_cover(tree, prefix)
+        except EPub.StructureException, error:
+            raise error
+        except Exception, error:
+            raise EPub.StructureException(error.message)
 
-    def __extract_metainfo(self):
-        root_info = self.__get_root_info()
+    def __extract_metainfo(self, root_info, tree):
         self.root_filename = root_info.filename
-        tree = self.__etree_from_entry(root_info)
-        namespaces = {'opf': EPub.Namespace.OPF, 'dc': EPub.Namespace.DUBLIN_CORE}
 
-        res = tree.xpath('/opf:package/opf:metadata/dc:title', namespaces=namespaces)
+        res = XPath.TITLE(tree)
         if len(res) > 0:
             self.__set_title__(res[0].text)
 
-        res = tree.xpath('/opf:package/opf:metadata/dc:creator[@role="aut"]', namespaces=namespaces)
+        res = XPath.MAIN_AUTHORS(tree)
         if len(res) == 0:
-            res = tree.xpath('/opf:package/opf:metadata/dc:creator', namespaces=namespaces)
+            res = XPath.AUTHORS(tree)
         for node in res:
             self.__add_author__(node.text)
 
-        res = tree.xpath('/opf:package/opf:metadata/dc:language', namespaces=namespaces)
+        res = XPath.LANGUAGE(tree)
         if len(res) > 0 and res[0].text:
             self.language_code = res[0].text.strip()
 
-        res = tree.xpath('/opf:package/opf:metadata/dc:subject', namespaces=namespaces)
+        res = XPath.SUBJECTS(tree)
         for node in res:
             self.__add_tag__(node.text)
 
-        res = tree.xpath('/opf:package/opf:metadata/opf:meta[@name="calibre:series"]', namespaces=namespaces)
+        res = XPath.META(tree, name='calibre:series')
         if len(res) > 0:
             series = BookFile.__normalise_string__(res[0].get('content'))
             if series:
-                res = tree.xpath('/opf:package/opf:metadata/opf:meta[@name="calibre:series_index"]', namespaces=namespaces)
+                res = XPath.META(tree, name='calibre:series_index')
                 index = BookFile.__normalise_string__(res[0].get('content')) if len(res) > 0 else None
                 self.series_info = {
                     'title': series,
                     'index': index or None
                 }
 
-        res = tree.xpath('/opf:package/opf:metadata/dc:description', namespaces=namespaces)
-        if len(res) > 0 and res[0].text:
-            self.description = res[0].text.strip()
-
-        prefix = os.path.dirname(root_info.filename)
-        if prefix:
-            prefix += '/'
-        self.cover_fileinfos = self.__find_cover(tree, prefix)
-
     def __find_cover(self, tree, prefix):
-        namespaces = {'opf': EPub.Namespace.OPF, 'dc': EPub.Namespace.DUBLIN_CORE}
-
-        def xpath(query):
-            return tree.xpath(query, namespaces=namespaces)[0]
-
-        def item_for_href(ref):
-            return xpath('/opf:package/opf:manifest/opf:item[@href="%s"]' % ref)
-
         def image_infos(node):
             path = os.path.normpath(prefix + node.get('href'))
             try:
@@ -160,7 +215,7 @@ class EPub(BookFile):
             elif mime == 'application/xhtml+xml':
                 xhtml = self.__etree_from_entry(fileinfo)
                 xhtml_prefix = os.path.dirname(fileinfo.filename) + '/'
-                img = xhtml.xpath('//xhtml:img[@src]', namespaces={'xhtml': EPub.Namespace.XHTML})[0]
+                img = XPath.XHTML_IMAGES(xhtml)[0]
                 return [info,
                     {
                         'filename': os.path.normpath(xhtml_prefix + img.get('src')),
@@ -171,45 +226,28 @@ class EPub(BookFile):
             else:
                 raise Exception('unknown mimetype %s' % mime)
 
-        try:
-            return image_infos(xpath('/opf:package/opf:manifest/opf:item[@properties="cover-image"]'))
-        except:
-            pass
-
-        try:
-            node = xpath('/opf:package/opf:metadata/opf:meta[@name="cover"]')
-            return image_infos(xpath('/opf:package/opf:manifest/opf:item[@id="%s"]' % node.get('content')))
-        except:
-            pass
-
-        try:
-            node = xpath('/opf:package/opf:metadata/meta[@name="cover"]')
-            return image_infos(xpath('/opf:package/opf:manifest/opf:item[@id="%s"]' % node.get('content')))
-        except:
-            pass
-
-        try:
-            node = xpath('/package/metadata/meta[@name="cover"]')
-            return image_infos(xpath('/package/manifest/item[@id="%s"]' % node.get('content')))
-        except:
-            pass
-
-        try:
-            node = xpath('/opf:package/opf:guide/opf:reference[@type="other.ms-coverimage-standard"][@title="Cover"]')
-            return image_infos(item_for_href(node.get('href')))
-        except:
-            pass
-
-        try:
-            node = xpath('/opf:package/opf:guide/opf:reference[@type="other.ms-coverimage-standard"]')
-            return image_infos(item_for_href(node.get('href')))
-        except:
-            pass
-
-        try:
-            return image_infos(xpath('/opf:package/opf:manifest/opf:item[@id="cover"]'))
-        except:
-            pass
+        def first(nodes):
+            return nodes[0] if len(nodes) > 0 else None
+
+        def candidates():
+            yield first(XPath.MANIFEST_ITEM_BY_PROPERTIES(tree, properties='cover-image'))
+            for meta in (XPath.META(tree, name='cover'), XPath.PLAIN_META_IN_OPF(tree, name='cover')):
+                if len(meta) > 0:
+                    yield first(XPath.MANIFEST_ITEM_BY_ID(tree, id=meta[0].get('content', '')))
+            meta = XPath.PLAIN_META(tree, name='cover')
+            if len(meta) > 0:
+                yield first(XPath.PLAIN_MANIFEST_ITEM(tree, id=meta[0].get('content', '')))
+            references = XPath.COVER_REFERENCES(tree)
+            for reference in [r for r in references if r.get('title') == 'Cover'][:1] + references[:1]:
+                yield first(XPath.MANIFEST_ITEM_BY_HREF(tree, href=reference.get('href', '')))
+            yield first(XPath.MANIFEST_ITEM_BY_ID(tree, id='cover'))
+
+        for node in candidates():
+            if node is not None:
+                try:
+                    return image_infos(node)
+                except:
+                    pass
 
         return []
 
@@ -219,10 +257,9 @@ class EPub(BookFile):
         except:
             container_info = None
         if container_info:
-            tree = self.__etree_from_entry(container_info)
+            tree = self.__meta_etree(EPub.Entry.CONTAINER)
             root_file = None
-            namespaces = {'cont': EPub.Namespace.CONTAINER}
-            res = tree.xpath('/cont:container/cont:rootfiles/cont:rootfile', namespaces=namespaces)
+            res = XPath.ROOT_FILES(tree)
             if len(res) == 1 and res[0].get('media-type') == 'application/oebps-package+xml':
                 root_file = res[0].get('full-path')
             if root_file:
@@ -246,13 +283,8 @@ class EPub(BookFile):
     def __extract_content_ids(self):
         content_ids = set()
         try:
-            tree = self.__etree_from_entry(EPub.Entry.ENCRYPTION)
-            ns = {
-                'c': EPub.Namespace.CONTAINER,
-                'e': EPub.Namespace.ENCRYPTION,
-                'd': EPub.Namespace.DIGITAL_SIGNATURE
-            }
-            res = tree.xpath('/c:encryption/e:EncryptedData/d:KeyInfo/d:KeyName', namespaces=ns)
+            tree = self.__meta_etree(EPub.Entry.ENCRYPTION)
+            res = XPath.KEY_NAMES(tree)
             for node in res:
                 key_name = res[0].text
                 if key_name and key_name.startswith(EPub.CONTENT_ID_PREFIX):
@@ -268,9 +300,8 @@ class EPub(BookFile):
 
         if self.__contains_entry(EPub.Entry.ENCRYPTION):
             try:
-                tree = self.__etree_from_entry(EPub.Entry.ENCRYPTION)
-                namespaces = {'c': EPub.Namespace.CONTAINER, 'e':EPub.Namespace.ENCRYPTION}
-                res = tree.xpath('/c:encryption/e:EncryptedData/e:EncryptionMethod', namespaces=namespaces)
+                tree = self.__meta_etree(EPub.Entry.ENCRYPTION)
+                res = XPath.ENCRYPTION_METHODS(tree)
                 algorithms = list(set([r.get('Algorithm') for r in res]))
                 if len(algorithms) != 1:
                     return {'method': 'multi', 'ids': algorithms}
@@ -286,9 +317,8 @@ class EPub(BookFile):
         if self.__contains_entry(EPub.Entry.RIGHTS):
             if algo == EPub.ALGORITHM_AES128:
                 try:
-                    tree = self.__etree_from_entry(EPub.Entry.RIGHTS)
-                    namespaces = {'m': EPub.Namespace.MARLIN}
-                    res = tree.xpath('/m:Marlin/m:RightsURL/m:RightsIssuer/m:URL', namespaces=namespaces)
+                    tree = self.__meta_etree(EPub.Entry.RIGHTS)
+                    res = XPath.RIGHTS_ISSUER_URLS(tree)
                     if res:
                         token_url = res[0].text
                         content_ids = self.__extract_content_ids() if token_url == EPub.TOKEN_URL else []
@@ -306,11 +336,8 @@ class EPub(BookFile):
 
         return {}
 
-    def __save_tree(self, zip_file, filename, tree, working_dir):
-        path = os.path.join(working_dir, filename)
-        with open(path, 'w') as pfile:
-            tree.write(pfile, pretty_print=True)
-        zip_file.write(path, arcname=filename)
+    def __save_tree(self, zip_file, filename, tree):
+        zip_file.writestr(filename, etree.tostring(tree, pretty_print=True))
 
     def __add_encryption_section(self, index, root, uri, content_id):
         # See http://www.marlin-community.com/files/marlin-EPUB-extension-v1.0.pdf
@@ -325,7 +352,7 @@ class EPub(BookFile):
         cipher_data = etree.SubElement(enc_data, etree.QName(EPub.Namespace.ENCRYPTION, 'CipherData'))
         etree.SubElement(cipher_data, etree.QName(EPub.Namespace.ENCRYPTION, 'CipherReference'), URI=uri)
 
-    def __create_encryption_file(self, zip_file, working_dir, encrypted_files, content_id):
+    def __create_encryption_file(self, zip_file, encrypted_files, content_id):
         namespaces = {
             None    :   EPub.Namespace.CONTAINER,
             'enc'   :   EPub.Namespace.ENCRYPTION,
@@ -339,9 +366,9 @@ class EPub(BookFile):
             self.__add_encryption_section(index, root, filename, content_id)
             index += 1
 
-        self.__save_tree(zip_file, EPub.Entry.ENCRYPTION, tree, working_dir)
+        self.__save_tree(zip_file, EPub.Entry.ENCRYPTION, tree)
 
-    def __create_rights_file(self, zip_file, working_dir):
+    def __create_rights_file(self, zip_file):
         namespaces = {None: EPub.Namespace.MARLIN}
         root = etree.Element(etree.QName(EPub.Namespace.MARLIN, 'Marlin'), nsmap=namespaces)
         tree = etree.ElementTree(root)
@@ -349,9 +376,14 @@ class EPub(BookFile):
         rights_url = etree.SubElement(root, etree.QName(EPub.Namespace.MARLIN, 'RightsURL'))
         rights_issuer = etree.SubElement(rights_url, etree.QName(EPub.Namespace.MARLIN, 'RightsIssuer'))
         etree.SubElement(rights_issuer, etree.QName(EPub.Namespace.MARLIN, 'URL')).text = EPub.TOKEN_URL
-        self.__save_tree(zip_file, EPub.Entry.RIGHTS, tree, working_dir)
-
-    def encrypt(self, key, content_id, working_dir, files_to_keep=None):
+        self.__save_tree(zip_file, EPub.Entry.RIGHTS, tree)
+
+    def encrypt(self, key, content_id, working_dir, files_to_keep=None, workers=1):
+        '''
+        workers:    number of threads compressing and encrypting entries;
+                    zlib and AES release GIL, so the threads run in parallel;
+                    1 (or less) means entries are encrypted in the calling thread
+        '''
         if self.get_encryption_info():
             raise Exception('Cannot encrypt file %s, it is already encrypted' % self.path)
 
@@ -360,37 +392,97 @@ class EPub(BookFile):
             files_to_keep += [self.root_filename]
             files_to_keep += [info['filename'] for info in self.cover_fileinfos]
 
-        self.__zip_file.extractall(path=working_dir)
-
-        new_epub = mktemp(dir=working_dir)
-        with zipfile.ZipFile(new_epub, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            zip_file.writestr(EPub.Entry.MIMETYPE, Mimetype.EPUB, zipfile.ZIP_STORED)
-            encrypted_files = []
-            for entry in [info.filename for info in list_zip_file_infos(self.__zip_file) if info.filename != EPub.Entry.MIMETYPE]:
-                path = os.path.join(working_dir, entry)
-                if entry in files_to_keep:
-                    zip_file.write(path, arcname=entry)
-                else:
-                    encrypt(os.path.join(working_dir, entry), key, working_dir)
-                    encrypted_files.append(entry)
-                    zip_file.write(path, arcname=entry, compress_type=zipfile.ZIP_STORED)
-            self.__create_encryption_file(zip_file, working_dir, encrypted_files, content_id)
-            self.__create_rights_file(zip_file, working_dir)
+        infos = [info for info in list_zip_file_infos(self.__zip_file) if info.filename != EPub.Entry.MIMETYPE]
+        pool = ThreadPool(workers) if workers > 1 else None
+        try:
+            # entries are copied/encrypted straight from the source archive,
+            # working_dir is used for the new archive file and for encrypted
+            # data not fitting ENCRYPTION_SPOOL_SIZE
+            new_epub = mktemp(dir=working_dir)
+            with zipfile.ZipFile(new_epub, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                zip_file.writestr(EPub.Entry.MIMETYPE, Mimetype.EPUB, zipfile.ZIP_STORED)
+                encrypted_files = []
+                for batch in EPub.__batches(infos, EPub.ENCRYPTION_BATCH_SIZE):
+                    to_encrypt = [info for info in batch if not info.filename in files_to_keep]
+                    mapper = pool.imap if pool else itertools.imap
+                    encrypted = mapper(lambda info: self.__encrypt_entry(info, key, working_dir), to_encrypt)
+                    for info in batch:
+                        if info.filename in files_to_keep:
+                            # kept entries are not decompressed
+                            copy_zip_entry(self.__zip_file, info, zip_file)
+                        else:
+                            writer = encrypted.next()
+                            try:
+                                writer.stream.seek(0)
+                                write_stored_entry(zip_file, info.filename, writer.stream, writer.size, writer.crc)
+                            finally:
+                                writer.stream.close()
+                            encrypted_files.append(info.filename)
+                self.__create_encryption_file(zip_file, encrypted_files, content_id)
+                self.__create_rights_file(zip_file)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
         shutil.move(new_epub, self.path)
         self.close()
         self.__initialize()
 
+    def __encrypt_entry(self, info, key, working_dir):
+        '''
+        returns ChecksumWriter over spooled file containing encrypted data;
+        the source archive is opened by path, so ZipFile.open gives every
+        thread its own file object
+        '''
+        writer = ChecksumWriter(SpooledTemporaryFile(EPub.ENCRYPTION_SPOOL_SIZE, dir=working_dir))
+        try:
+            with self.__zip_file.open(info) as istream:
+                encrypt_stream(istream, writer, key)
+        except:
+            writer.stream.close()
+            raise
+        return writer
+
+    @staticmethod
+    def __batches(infos, batch_size):
+        '''
+        splits entries into groups of total uncompressed size
+        not exceeding batch_size (but at least one entry)
+        '''
+        batch = []
+        size = 0
+        for info in infos:
+            if batch and size + info.file_size > batch_size:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(info)
+            size += info.file_size
+        if batch:
+            yield batch
+
     def repair(self, working_dir):
-        self.__zip_file.extractall(path=working_dir)
+        '''
+        fixes mimetype entry in place, rewriting archive head and central
+        directory only (entries overlapping the new mimetype entry are moved
+        to the end of the archive); if the archive layout does not allow it,
+        writes new archive: stored mimetype entry first, other entries are
+        copied in compressed form, without extraction and recompression
+        '''
+        self.close()
+        if not store_entry_first(self.path, EPub.Entry.MIMETYPE, Mimetype.EPUB, working_dir):
+            self.__rebuild(working_dir)
+        self.__initialize()
 
+    def __rebuild(self, working_dir):
         new_epub = mktemp(dir=working_dir)
-        with zipfile.ZipFile(new_epub, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            zip_file.writestr(EPub.Entry.MIMETYPE, Mimetype.EPUB, zipfile.ZIP_STORED)
-            for entry in [info.filename for info in list_zip_file_infos(self.__zip_file) if info.filename != EPub.Entry.MIMETYPE]:
-                zip_file.write(os.path.join(working_dir, entry), arcname=entry)
+        with zipfile.ZipFile(self.path) as old_file:
+            with zipfile.ZipFile(new_epub, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                zip_file.writestr(EPub.Entry.MIMETYPE, Mimetype.EPUB, zipfile.ZIP_STORED)
+                for info in list_zip_file_infos(old_file):
+                    if info.filename != EPub.Entry.MIMETYPE:
+                        copy_zip_entry(old_file, info, zip_file)
         shutil.move(new_epub, self.path)
-        self.close()
-        self.__initialize()
 
     def extract_cover_internal(self, working_dir):
         if len(self.cover_fileinfos) == 0:
@@ -402,3 +494,44 @@ class EPub(BookFile):
             shutil.move(os.path.join(working_dir, name), os.path.join(working_dir, split[-1]))
             shutil.rmtree(os.path.join(working_dir, split[0]))
         return (split[-1] if len(split) > 0 else None, False)
+
+    def extract_cover_data(self):
+        if len(self.cover_fileinfos) == 0:
+            return None
+        return self.__zip_file.read(self.cover_fileinfos[-1]['filename'])
+
+class XPath(object):
+    '''
+    queries used by EPub, compiled once per process
+    '''
+    NAMESPACES = {
+        'opf': EPub.Namespace.OPF,
+        'dc': EPub.Namespace.DUBLIN_CORE,
+        'cont': EPub.Namespace.CONTAINER,
+        'enc': EPub.Namespace.ENCRYPTION,
+        'ds': EPub.Namespace.DIGITAL_SIGNATURE,
+        'm': EPub.Namespace.MARLIN,
+        'xhtml': EPub.Namespace.XHTML
+    }
+
+    TITLE = etree.XPath('/opf:package/opf:metadata/dc:title', namespaces=NAMESPACES)
+    MAIN_AUTHORS = etree.XPath('/opf:package/opf:metadata/dc:creator[@role="aut"]', namespaces=NAMESPACES)
+    AUTHORS = etree.XPath('/opf:package/opf:metadata/dc:creator', namespaces=NAMESPACES)
+    LANGUAGE = etree.XPath('/opf:package/opf:metadata/dc:language', namespaces=NAMESPACES)
+    SUBJECTS = etree.XPath('/opf:package/opf:metadata/dc:subject', namespaces=NAMESPACES)
+    DESCRIPTION = etree.XPath('/opf:package/opf:metadata/dc:description', namespaces=NAMESPACES)
+    META = etree.XPath('/opf:package/opf:metadata/opf:meta[@name=$name]', namespaces=NAMESPACES)
+    PLAIN_META_IN_OPF = etree.XPath('/opf:package/opf:metadata/meta[@name=$name]', namespaces=NAMESPACES)
+    PLAIN_META = etree.XPath('/package/metadata/meta[@name=$name]')
+    MANIFEST_ITEM_BY_ID = etree.XPath('/opf:package/opf:manifest/opf:item[@id=$id]', namespaces=NAMESPACES)
+    MANIFEST_ITEM_BY_HREF = etree.XPath('/opf:package/opf:manifest/opf:item[@href=$href]', namespaces=NAMESPACES)
+    MANIFEST_ITEM_BY_PROPERTIES = etree.XPath('/opf:package/opf:manifest/opf:item[@properties=$properties]', namespaces=NAMESPACES)
+    PLAIN_MANIFEST_ITEM = etree.XPath('/package/manifest/item[@id=$id]')
+    COVER_REFERENCES = etree.XPath(
+        '/opf:package/opf:guide/opf:reference[@type="other.ms-coverimage-standard"]', namespaces=NAMESPACES
+    )
+    XHTML_IMAGES = etree.XPath('//xhtml:img[@src]', namespaces=NAMESPACES)
+    ROOT_FILES = etree.XPath('/cont:container/cont:rootfiles/cont:rootfile', namespaces=NAMESPACES)
+    KEY_NAMES = etree.XPath('/cont:encryption/enc:EncryptedData/ds:KeyInfo/ds:KeyName', namespaces=NAMESPACES)
+    ENCRYPTION_METHODS = etree.XPath('/cont:encryption/enc:EncryptedData/enc:EncryptionMethod', namespaces=NAMESPACES)
+    RIGHTS_ISSUER_URLS = etree.XPath('/m:Marlin/m:RightsURL/m:RightsIssuer/m:URL', namespaces=NAMESPACES)
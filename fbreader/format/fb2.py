@@ -2,9 +2,9 @@ import base64, os, traceback, zipfile
 from lxml import etree
 from abc import abstractmethod
 
-from fbreader.format.bookfile import BookFile
+from fbreader.format.bookfile import BookFile, MetadataGroup
 from fbreader.format.mimetype import Mimetype
-from fbreader.format.util import list_zip_file_infos
+from fbreader.format.util import list_zip_file_infos, verify_zip_file, Verification
 
 class FB2StructureException(Exception):
     def __init__(self, error):
@@ -17,152 +17,239 @@ class Namespace(object):
     XLINK = 'http://www.w3.org/1999/xlink'
 
 class FB2Base(BookFile):
-    def __init__(self, path, original_filename, mimetype):
+    def __init__(self, path, original_filename, mimetype, lazy=False):
+        '''
+        lazy:   do not parse the document header in constructor,
+                metadata fields are extracted on first access
+        '''
         BookFile.__init__(self, path, original_filename, mimetype)
-        self.__namespaces = {'fb': Namespace.FICTION_BOOK, 'xlink': Namespace.XLINK}
+        self.__cover_id = None
+        self.__content = None
+        self.__events = None
+        self.__title_info = None
+        if not lazy:
+            self.__load_all_metadata__()
+
+    def __load_metadata__(self, group):
         try:
-            tree = self.__create_tree__()
-            self.__detect_title(tree)
-            self.__detect_authors(tree)
-            self.__detect_tags(tree)
-            self.__detect_series_info(tree)
-            self.__detect_language(tree)
-            description = self.__detect_description(tree)
-            if description:
-                self.description = description.strip()
+            if self.__title_info is None:
+                self.__title_info = self.__read_title_info(self.__create_header_tree())
+            info = self.__title_info
+            if group == MetadataGroup.HEADER:
+                self.__apply_header(info)
+            elif group == MetadataGroup.DESCRIPTION:
+                if 'annotation' in info:
+                    description = etree.tostring(info['annotation'], encoding='utf-8', method='text')
+                    if description:
+                        self.description = description.strip()
+            elif group == MetadataGroup.COVER:
+                if 'image' in info:
+                    href = info['image'].get('{' + Namespace.XLINK + '}href')
+                    if href:
+                        self.__cover_id = href[1:]
         except FB2StructureException, error:
+            self.__close_content()
             raise error
         except Exception, error:
+            self.__close_content()
             raise FB2StructureException(error)
 
     @abstractmethod
-    def __create_tree__(self):
+    def __open_content__(self):
+        '''
+        returns file-like object for reading FB2 XML document
+        '''
         return None
 
+    def __exit__(self, kind, value, traceback):
+        self.__close_content()
+
+    def __start_parsing(self):
+        self.__close_content()
+        self.__content = self.__open_content__()
+        # paragraphs and verses are reported to be released during cover
+        # search, otherwise a single long section would stay in memory
+        self.__events = etree.iterparse(
+            self.__content,
+            events=('end',),
+            tag=('{*}description', '{*}body', '{*}section', '{*}p', '{*}v', '{*}binary'),
+            huge_tree=True
+        )
+
+    def __close_content(self):
+        if self.__content:
+            self.__content.close()
+        self.__content = None
+        self.__events = None
+
+    def __create_header_tree(self):
+        '''
+        parses document up to the end of <description> element only;
+        the parser is kept open, so cover extraction continues from
+        the same position instead of reading the document again
+        '''
+        self.__start_parsing()
+        try:
+            for event, node in self.__events:
+                if etree.QName(node).localname == 'description':
+                    return node.getroottree()
+        except etree.XMLSyntaxError:
+            raise FB2StructureException('the file is not a valid XML')
+        return etree.ElementTree(self.__events.root)
+
     def extract_cover_internal(self, working_dir):
+        data = self.extract_cover_data()
+        if not data:
+            return (None, False)
+        with open(os.path.join(working_dir, 'cover.jpeg'), 'wb') as cover_file:
+            cover_file.write(data)
+        return ('cover.jpeg', False)
+
+    def extract_cover_data(self):
+        self.__require__(MetadataGroup.COVER)
+        if not self.__cover_id:
+            return None
         try:
-            tree = self.__create_tree__()
-            res = tree.xpath('/fb:FictionBook/fb:description/fb:title-info/fb:coverpage/fb:image', namespaces=self.__namespaces)
-            cover_id = res[0].get('{' + Namespace.XLINK + '}href')[1:]
-            res = tree.xpath('//fb:binary[@id="%s"]' % cover_id, namespaces=self.__namespaces)
-            content = base64.b64decode(res[0].text)
-            with open(os.path.join(working_dir, 'cover.jpeg'), 'wb') as cover_file:
-                cover_file.write(content)
-            return ('cover.jpeg', False)
+            if self.__events is None:
+                self.__start_parsing()
+            try:
+                for event, node in self.__events:
+                    if etree.QName(node).localname == 'binary' and node.get('id') == self.__cover_id:
+                        return base64.b64decode(node.text)
+                    # drop processed nodes to keep memory usage bounded
+                    node.clear()
+                    while node.getprevious() is not None:
+                        del node.getparent()[0]
+            finally:
+                self.__close_content()
         except:
-            return (None, False)
-
-    def __detect_title(self, tree):
-        res = tree.xpath('/fb:FictionBook/fb:description/fb:title-info/fb:book-title', namespaces=self.__namespaces)
-        if len(res) == 0:
-            res = tree.xpath('/FictionBook/description/title-info/book-title')
-        if len(res) > 0:
-            self.__set_title__(res[0].text)
-
+            pass
         return None
 
-    def __detect_authors(self, tree):
-        use_namespaces = True
-
+    def __read_title_info(self, tree):
+        '''
+        collects metadata nodes in a single walk over <title-info> children;
+        the namespaced or plain element names are chosen by the root tag
+        '''
+        root = tree.getroot()
+        if root is None:
+            return {}
+        if root.tag == '{%s}FictionBook' % Namespace.FICTION_BOOK:
+            prefix = '{%s}' % Namespace.FICTION_BOOK
+        elif root.tag == 'FictionBook':
+            prefix = ''
+        else:
+            return {}
+
+        TITLE = prefix + 'book-title'
+        AUTHOR = prefix + 'author'
+        GENRE = prefix + 'genre'
+        SEQUENCE = prefix + 'sequence'
+        LANG = prefix + 'lang'
+        ANNOTATION = prefix + 'annotation'
+        COVERPAGE = prefix + 'coverpage'
+        KEYS = {
+            TITLE: 'title',
+            SEQUENCE: 'sequence',
+            LANG: 'lang',
+            ANNOTATION: 'annotation'
+        }
+
+        info = {'prefix': prefix, 'authors': [], 'genres': []}
+        for description in root.iterchildren(prefix + 'description'):
+            for title_info in description.iterchildren(prefix + 'title-info'):
+                for node in title_info.iterchildren(TITLE, AUTHOR, GENRE, SEQUENCE, LANG, ANNOTATION, COVERPAGE):
+                    if node.tag == AUTHOR:
+                        info['authors'].append(node)
+                    elif node.tag == GENRE:
+                        info['genres'].append(node)
+                    elif node.tag == COVERPAGE:
+                        if not 'image' in info:
+                            image = node.find(prefix + 'image')
+                            if image is not None:
+                                info['image'] = image
+                    elif not KEYS[node.tag] in info:
+                        info[KEYS[node.tag]] = node
+        return info
+
+    def __apply_header(self, info):
         def subnode_text(node, name):
-            if use_namespaces:
-                subnode = node.find('fb:' + name, namespaces=self.__namespaces)
-            else:
-                subnode = node.find(name)
+            subnode = node.find(info['prefix'] + name)
             text = subnode.text if subnode is not None else ''
             return text or ''
 
-        def add_author_from_node(node):
+        if 'title' in info:
+            self.__set_title__(info['title'].text)
+
+        for node in info.get('authors', []):
             first_name = subnode_text(node, 'first-name')
             middle_name = subnode_text(node, 'middle-name')
             last_name = subnode_text(node, 'last-name')
             self.__add_author__(' '.join([first_name, middle_name, last_name]), last_name)
 
-        res = tree.xpath('/fb:FictionBook/fb:description/fb:title-info/fb:author', namespaces=self.__namespaces)
-        if len(res) == 0:
-            use_namespaces = False
-            res = tree.xpath('/FictionBook/description/title-info/author')
-
-        for node in res:
-            add_author_from_node(node)
-
-    def __detect_language(self, tree):
-        res = tree.xpath('/fb:FictionBook/fb:description/fb:title-info/fb:lang', namespaces=self.__namespaces)
-        if len(res) == 0:
-            use_namespaces = False
-            res = tree.xpath('/FictionBook/description/title-info/lang')
-        if len(res) > 0:
-            self.language_code = res[0].text
-
-    def __detect_tags(self, tree):
-        res = tree.xpath('/fb:FictionBook/fb:description/fb:title-info/fb:genre', namespaces=self.__namespaces)
-        if len(res) == 0:
-            use_namespaces = False
-            res = tree.xpath('/FictionBook/description/title-info/genre')
-        for node in res:
+        for node in info.get('genres', []):
             self.__add_tag__(node.text)
 
-    def __detect_series_info(self, tree):
-        res = tree.xpath('/fb:FictionBook/fb:description/fb:title-info/fb:sequence', namespaces=self.__namespaces)
-        if len(res) == 0:
-            use_namespaces = False
-            res = tree.xpath('/FictionBook/description/title-info/sequence')
-        if len(res) > 0:
-            title = BookFile.__normalise_string__(res[0].get('name'))
-            index = BookFile.__normalise_string__(res[0].get('number'))
+        if 'sequence' in info:
+            title = BookFile.__normalise_string__(info['sequence'].get('name'))
+            index = BookFile.__normalise_string__(info['sequence'].get('number'))
             if title:
                 self.series_info = {
                     'title': title,
                     'index': index or None
                 }
 
-    def __detect_description(self, tree):
-        res = tree.xpath('/fb:FictionBook/fb:description/fb:title-info/fb:annotation', namespaces=self.__namespaces)
-        if len(res) == 0:
-            res = tree.xpath('/FictionBook/description/title-info/annotation')
-        if len(res) > 0:
-            return etree.tostring(res[0], encoding='utf-8', method='text')
-
-        return None
+        if 'lang' in info:
+            self.language_code = info['lang'].text
 
 class FB2(FB2Base):
-    def __init__(self, path, original_filename):
-        FB2Base.__init__(self, path, original_filename, Mimetype.FB2)
+    def __init__(self, path, original_filename, lazy=False):
+        FB2Base.__init__(self, path, original_filename, Mimetype.FB2, lazy)
 
-    def __create_tree__(self):
-        try:
-            return etree.parse(self.path)
-        except:
-            raise FB2StructureException('the file is not a valid XML')
-
-    def __exit__(self, kind, value, traceback):
-        pass
+    def __open_content__(self):
+        return open(self.path, 'rb')
 
 class FB2Zip(FB2Base):
-    def __init__(self, path, original_filename):
-        self.__zip_file = zipfile.ZipFile(path)
+    def __init__(self, path, original_filename, verification=Verification.FULL, detection=None, lazy=False):
+        '''
+        detection:  Detection object for the file; its open archive
+                    is used instead of opening and verifying it again
+        '''
+        if detection is not None and detection.zip_file is not None:
+            self.__zip_file = detection.zip_file
+            self.__infos = detection.infos
+        else:
+            self.__zip_file = zipfile.ZipFile(path)
+            try:
+                if verify_zip_file(self.__zip_file, verification):
+                    raise FB2StructureException('broken zip archive')
+                self.__infos = list_zip_file_infos(self.__zip_file)
+                if len(self.__infos) != 1:
+                    raise FB2StructureException('archive contains %s files' % len(self.__infos))
+            except FB2StructureException, error:
+                self.__zip_file.close()
+                raise error
+            except Exception, error:
+                self.__zip_file.close()
+                raise FB2StructureException(error)
+
         try:
-            if self.__zip_file.testzip():
-                raise FB2StructureException('broken zip archive')
-            self.__infos = list_zip_file_infos(self.__zip_file)
-            if len(self.__infos) != 1:
-                raise FB2StructureException('archive contains %s files' % len(self.__infos))
-        except FB2StructureException, error:
-            self.__zip_file.close()
-            raise error
-        except Exception, error:
+            FB2Base.__init__(self, path, original_filename, Mimetype.FB2_ZIP, lazy)
+        except:
             self.__zip_file.close()
-            raise FB2StructureException(error)
+            raise
 
-        FB2Base.__init__(self, path, original_filename, Mimetype.FB2_ZIP)
+    def __open_content__(self):
+        return self.__zip_file.open(self.__infos[0])
 
-    def __create_tree__(self):
-        with self.__zip_file.open(self.__infos[0]) as entry:
-            try:
-                return etree.fromstring(entry.read(50 * 1024 * 1024))
-            except:
-                raise FB2StructureException('\'%s\' is not a valid XML' % self.__infos[0].filename)
+    def validate(self):
+        try:
+            broken = self.__zip_file.testzip()
+        except:
+            broken = True
+        if broken:
+            raise FB2StructureException('broken zip archive')
 
     def __exit__(self, kind, value, traceback):
+        FB2Base.__exit__(self, kind, value, traceback)
         self.__zip_file.__exit__(kind, value, traceback)
-        pass
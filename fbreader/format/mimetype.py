@@ -12,3 +12,7 @@ class Mimetype:
     DJVU = 'image/vnd.djvu'
     TEXT = 'text/plain'
     RTF = 'text/rtf'
+
+    JPEG = 'image/jpeg'
+    PNG = 'image/png'
+    GIF = 'image/gif'
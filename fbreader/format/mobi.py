@@ -3,35 +3,67 @@ from tempfile import mkdtemp
 
 from pymobi.mobi import BookMobi
 
-from fbreader.format.bookfile import BookFile
+from fbreader.format.bookfile import BookFile, MetadataGroup
 from fbreader.format.mimetype import Mimetype
 
 class Mobipocket(BookFile):
-    def __init__(self, path, original_filename):
+    def __init__(self, path, original_filename, lazy=False):
+        '''
+        lazy:   do not read the file in constructor, metadata fields
+                are extracted on first access
+        '''
         BookFile.__init__(self, path, original_filename, Mimetype.MOBI)
-        bm = BookMobi(path)
-        self._encryption_method = bm['encryption']
-        self.__set_title__(bm['title'])
-        self.__add_author__(bm['author'])
-        if bm['subject']:
-            for tag in bm['subject']:
-                self.__add_tag__(tag)
-        self.description = bm['description']
+        self.__book = None
+        if not lazy:
+            self.__load_all_metadata__()
+
+    def __book_mobi(self):
+        if self.__book is None:
+            self.__book = BookMobi(self.path)
+        return self.__book
+
+    def __load_metadata__(self, group):
+        bm = self.__book_mobi()
+        if group == MetadataGroup.HEADER:
+            self.__set_title__(bm['title'])
+            self.__add_author__(bm['author'])
+            if bm['subject']:
+                for tag in bm['subject']:
+                    self.__add_tag__(tag)
+        elif group == MetadataGroup.DESCRIPTION:
+            self.description = bm['description']
+
+    def close(self):
+        # BookMobi keeps the book file open
+        self.__book = None
 
     def __exit__(self, kind, value, traceback):
-        pass
+        self.close()
 
     def get_encryption_info(self):
-        return {'method': self._encryption_method} if self._encryption_method != 'no encryption' else {}
+        encryption_method = self.__book_mobi()['encryption']
+        return {'method': encryption_method} if encryption_method != 'no encryption' else {}
 
     def extract_cover_internal(self, working_dir):
+        data = self.__unpack_cover(working_dir)
+        if not data:
+            return (None, False)
+        with open(os.path.join(working_dir, 'bookmobi_cover.jpg'), 'wb') as cover_file:
+            cover_file.write(data)
+        return ('bookmobi_cover.jpg', False)
+
+    def extract_cover_data(self):
+        return self.__unpack_cover(None)
+
+    def __unpack_cover(self, working_dir):
+        # pymobi unpacks all the book resources into files; working_dir
+        # is None for the system temp directory
         tmp_dir = mkdtemp(dir=working_dir)
-        BookMobi(self.path).unpackMobi(tmp_dir + '/bookmobi')
         try:
+            self.__book_mobi().unpackMobi(tmp_dir + '/bookmobi')
             if os.path.isfile(tmp_dir + '/bookmobi_cover.jpg'):
-                shutil.copy(tmp_dir + '/bookmobi_cover.jpg', working_dir)
-                return ('bookmobi_cover.jpg', False)
-            else:
-                return (None, False)
+                with open(tmp_dir + '/bookmobi_cover.jpg', 'rb') as cover_file:
+                    return cover_file.read()
+            return None
         finally:
             shutil.rmtree(tmp_dir)
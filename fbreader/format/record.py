@@ -0,0 +1,137 @@
+import struct
+from collections import namedtuple
+
+class BookRecord(namedtuple('BookRecord', [
+    'path',
+    'mimetype',
+    'title',
+    # tuple of (name, sortkey) tuples
+    'authors',
+    # tuple of strings
+    'tags',
+    'series_title',
+    'series_index',
+    'language_code',
+    'description'
+])):
+    '''
+    Detached immutable book metadata: no open archives or parsed trees,
+    tuples instead of lists and dicts, no per-instance __dict__.
+    Repeated strings (mimetypes, tags, languages) are shared between
+    records. Use BookFile.to_record() to create, pack()/unpack() to
+    store records in a compact binary form.
+    '''
+    __slots__ = ()
+
+    __STRINGS = {}
+    __NONE = 0xFFFFFFFF
+    # length flag: byte string (e.g. path in the file system encoding),
+    # stored and restored as is; unicode strings are stored in UTF-8
+    __BYTES = 0x80000000
+
+    @staticmethod
+    def shared(text):
+        '''
+        returns the same object for equal strings
+        '''
+        if text is None:
+            return None
+        return BookRecord.__STRINGS.setdefault(text, text)
+
+    @staticmethod
+    def from_book(book):
+        series = book.series_info or {}
+        return BookRecord(
+            path=book.path,
+            mimetype=BookRecord.shared(book.mimetype),
+            title=book.title,
+            authors=tuple((a['name'], BookRecord.shared(a['sortkey'])) for a in book.authors),
+            tags=tuple(BookRecord.shared(t) for t in book.tags),
+            series_title=series.get('title'),
+            series_index=series.get('index'),
+            language_code=BookRecord.shared(book.language_code),
+            description=book.description
+        )
+
+    def pack(self):
+        '''
+        returns binary representation: length-prefixed strings (unicode
+        strings in UTF-8, byte strings flagged and written as is),
+        authors and tags are preceded by their count
+        '''
+        parts = []
+        def put(text):
+            if text is None:
+                parts.append(struct.pack('<I', BookRecord.__NONE))
+            elif isinstance(text, unicode):
+                text = text.encode('utf-8')
+                parts.append(struct.pack('<I', len(text)))
+                parts.append(text)
+            else:
+                parts.append(struct.pack('<I', len(text) | BookRecord.__BYTES))
+                parts.append(text)
+
+        for text in (self.path, self.mimetype, self.title):
+            put(text)
+        parts.append(struct.pack('<H', len(self.authors)))
+        for name, sortkey in self.authors:
+            put(name)
+            put(sortkey)
+        parts.append(struct.pack('<H', len(self.tags)))
+        for tag in self.tags:
+            put(tag)
+        for text in (self.series_title, self.series_index, self.language_code, self.description):
+            put(text)
+        return ''.join(parts)
+
+    @staticmethod
+    def unpack(data, offset=0):
+        '''
+        data:   string produced by pack() (or several such strings joined)
+        offset: position of the record in data
+        returns (BookRecord, offset of the next record)
+        '''
+        position = [offset]
+        def get(fmt):
+            value, = struct.unpack_from(fmt, data, position[0])
+            position[0] += struct.calcsize(fmt)
+            return value
+        def text():
+            length = get('<I')
+            if length == BookRecord.__NONE:
+                return None
+            start = position[0]
+            if length & BookRecord.__BYTES:
+                position[0] += length & ~BookRecord.__BYTES
+                return data[start:position[0]]
+            position[0] += length
+            return data[start:position[0]].decode('utf-8')
+
+        path, mimetype, title = text(), BookRecord.shared(text()), text()
+        authors = tuple((text(), BookRecord.shared(text())) for i in range(get('<H')))
+        tags = tuple(BookRecord.shared(text()) for i in range(get('<H')))
+        series_title, series_index = text(), text()
+        language_code = BookRecord.shared(text())
+        description = text()
+        return (BookRecord(
+            path, mimetype, title, authors, tags,
+            series_title, series_index, language_code, description
+        ), position[0])
+
+    def to_dict(self):
+        '''
+        returns metadata in BookFile attribute format
+        '''
+        return {
+            'path': self.path,
+            'mimetype': self.mimetype,
+            'title': self.title,
+            'authors': [{'name': name, 'sortkey': sortkey} for name, sortkey in self.authors],
+            'tags': list(self.tags),
+            'series_info': {
+                'title': self.series_title,
+                'index': self.series_index
+            } if self.series_title else None,
+            'language_code': self.language_code,
+            'description': self.description
+        }
@@ -0,0 +1,44 @@
+from fbreader.format.mimetype import Mimetype
+
+# number of leading bytes enough for all the signatures below
+HEAD_SIZE = 512
+
+__SIGNATURES = [
+    ('PK\x03\x04', Mimetype.ZIP),
+    ('PK\x05\x06', Mimetype.ZIP),
+    ('\xff\xd8\xff', Mimetype.JPEG),
+    ('\x89PNG\r\n\x1a\n', Mimetype.PNG),
+    ('GIF87a', Mimetype.GIF),
+    ('GIF89a', Mimetype.GIF),
+]
+
+__BOMS = [
+    ('\xef\xbb\xbf', 'utf-8'),
+    ('\xff\xfe', 'utf-16-le'),
+    ('\xfe\xff', 'utf-16-be'),
+]
+
+def detect_by_signature(head):
+    '''
+    head:   first HEAD_SIZE bytes of the file (or the whole file if shorter)
+    returns mimetype for the formats handled by the library, None otherwise
+    '''
+    for signature, mimetype in __SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    if head[60:68] == 'BOOKMOBI':
+        return Mimetype.MOBI
+    if __is_xml(head):
+        return Mimetype.XML
+    return None
+
+def __is_xml(head):
+    for bom, encoding in __BOMS:
+        if head.startswith(bom):
+            try:
+                head = head[len(bom):len(bom) + 64].decode(encoding, 'ignore').encode('utf-8')
+            except:
+                return False
+            break
+    head = head.lstrip()
+    return head.startswith('<?xml') or head.startswith('<FictionBook')
@@ -1,23 +1,274 @@
-import PythonMagick
-from PIL import Image, ImageFile
+import copy, os, struct, tempfile, time, zipfile
+
+from fbreader.format.cover import CoverImage
+
+class Verification(object):
+    # no up-front checks; entries are CRC-checked by zipfile when read
+    LAZY = 'lazy'
+    # local headers of all entries are checked against the central
+    # directory, entry data is not decompressed
+    CENTRAL_DIRECTORY = 'central-directory'
+    # all entries are decompressed and CRC-checked (ZipFile.testzip)
+    FULL = 'full'
+
+    ALL = (LAZY, CENTRAL_DIRECTORY, FULL)
+
+class Detection(object):
+    '''
+    File type detection result. Keeps the data collected during detection
+    (open zip archive and list of its entries), so book classes
+    do not open and scan the file again. The archive is owned by the book
+    object it is passed to; call close() if no book object is created.
+    '''
+    def __init__(self, mimetype, zip_file=None, infos=None):
+        self.mimetype = mimetype
+        self.zip_file = zip_file
+        self.infos = infos
+
+    def close(self):
+        if self.zip_file:
+            self.zip_file.close()
+            self.zip_file = None
 
 def list_zip_file_infos(zipfile):
     return [info for info in zipfile.infolist() if not info.filename.endswith('/')]
 
-def minify_cover(path):
-    try:
+def verify_zip_file(zip_file, verification):
+    '''
+    returns name of the first broken entry, or None if verification passed
+    '''
+    if verification == Verification.FULL:
+        return zip_file.testzip()
+    elif verification == Verification.CENTRAL_DIRECTORY:
+        return __check_local_headers(zip_file)
+    return None
+
+def __check_local_headers(zip_file):
+    fp = zip_file.fp
+    fp.seek(0, os.SEEK_END)
+    file_size = fp.tell()
+    for info in zip_file.infolist():
+        fp.seek(info.header_offset)
+        header = fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader:
+            return info.filename
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            return info.filename
+        data_end = info.header_offset + zipfile.sizeFileHeader + \
+            fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH] + info.compress_size
+        if data_end > file_size:
+            return info.filename
+    return None
+
+def copy_zip_entry(source, info, target, chunk_size=1024*1024):
+    '''
+    source:     ZipFile to copy the entry from
+    info:       ZipInfo of the entry in source archive
+    target:     ZipFile opened for writing
+    chunk_size: size of blocks to copy
+
+    Copies entry data as stored in the source archive, without
+    decompressing and compressing it again; only the local header
+    (and data descriptor, if any) is written anew.
+    '''
+    fp = source.fp
+    fp.seek(info.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipfile('truncated local header of %s' % info.filename)
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile('bad local header of %s' % info.filename)
+    fp.seek(fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    new_info = copy.copy(info)
+    # zip64 sizes are added back by zipfile if needed
+    new_info.extra = zipfile._strip_extra(info.extra, (1,))
+    new_info.header_offset = target.fp.tell()
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    target.fp.write(new_info.FileHeader(zip64))
+    remaining = info.compress_size
+    while remaining > 0:
+        data = fp.read(min(remaining, chunk_size))
+        if not data:
+            raise zipfile.BadZipfile('truncated data of %s' % info.filename)
+        target.fp.write(data)
+        remaining -= len(data)
+    if new_info.flag_bits & 0x08:
+        fmt = '<LQQ' if zip64 else '<LLL'
+        target.fp.write(struct.pack(fmt, new_info.CRC, new_info.compress_size, new_info.file_size))
+    target.filelist.append(new_info)
+    target.NameToInfo[new_info.filename] = new_info
+    target._didModify = True
+
+class ChecksumWriter(object):
+    '''
+    Write-only file-like object: passes data to the underlying stream,
+    computing CRC-32 and size of the data written.
+    '''
+    def __init__(self, ostream):
+        self.stream = ostream
+        self.crc = 0
+        self.size = 0
+
+    def write(self, data):
+        self.crc = zipfile.crc32(data, self.crc)
+        self.size += len(data)
+        self.stream.write(data)
+
+    def flush(self):
+        pass
+
+def write_stored_entry(target, name, istream, size, crc, chunk_size=1024*1024):
+    '''
+    target:     ZipFile opened for writing
+    name:       entry name
+    istream:    file-like object to read entry content from
+    size:       content size
+    crc:        content CRC-32
+    chunk_size: size of blocks to copy
+
+    Writes uncompressed entry, streaming content from istream;
+    unlike ZipFile.writestr, the content is never kept in memory.
+    '''
+    info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    info.external_attr = 0600 << 16
+    info.file_size = info.compress_size = size
+    info.CRC = crc & 0xffffffff
+    info.header_offset = target.fp.tell()
+    target.fp.write(info.FileHeader(size > zipfile.ZIP64_LIMIT))
+    remaining = size
+    while remaining > 0:
+        data = istream.read(min(remaining, chunk_size))
+        if not data:
+            raise IOError('unexpected end of %s data' % name)
+        target.fp.write(data)
+        remaining -= len(data)
+    target.filelist.append(info)
+    target.NameToInfo[name] = info
+    target._didModify = True
+
+def store_entry_first(path, name, data, backup_dir, chunk_size=1024*1024):
+    '''
+    path:       zip archive to modify in place
+    name:       entry name
+    data:       entry content
+    backup_dir: directory for the copy of the archive regions
+                being overwritten
+
+    Makes uncompressed entry with given content the first one in the
+    archive, rewriting the archive head and central directory only:
+    entries overlapping the space needed for the new entry are moved
+    to the end of the archive. No padding extra field is used, since
+    e.g. ePub containers do not allow extra fields in the mimetype header;
+    the gap between the new entry and the next local header, as well as
+    old entry data (if it is not in the head), stays in the file unreferenced.
+    The modification is not atomic: the head and the central directory are
+    copied to a backup file in backup_dir first; the archive is restored from
+    it if writing fails. If the process dies while writing, the backup file
+    is left in backup_dir.
+    Returns False (and leaves the file untouched) if the archive layout
+    does not allow the modification.
+    '''
+    with open(path, 'r+b') as fp:
+        zip_file = zipfile.ZipFile(fp, 'a')
+        infos = sorted(zip_file.infolist(), key=lambda info: info.header_offset)
+        old_info = zip_file.NameToInfo.get(name)
+        if old_info is None or infos[0].header_offset != 0:
+            return False
+
+        new_info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        new_info.compress_type = zipfile.ZIP_STORED
+        new_info.external_attr = 0600 << 16
+        new_info.file_size = new_info.compress_size = len(data)
+        new_info.CRC = zipfile.crc32(data) & 0xffffffff
+        new_info.header_offset = 0
+        needed = len(new_info.FileHeader(False)) + len(data)
+
+        ends = [info.header_offset for info in infos[1:]] + [zip_file.start_dir]
+        head = [(info, end) for info, end in zip(infos, ends) if info.header_offset < needed]
+
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        # moved entries go after the new entry even if the archive
+        # is smaller than the space needed
+        position = max(zip_file.start_dir, needed)
+        backup = __backup_regions(fp, [(0, min(needed, zip_file.start_dir)), (zip_file.start_dir, size)], backup_dir, chunk_size)
         try:
-            image = Image.open(path).convert('RGB')
+            for info, end in head:
+                if info is old_info:
+                    continue
+                offset = info.header_offset
+                info.header_offset = position
+                while offset < end:
+                    fp.seek(offset)
+                    block = fp.read(min(end - offset, chunk_size))
+                    if not block:
+                        raise zipfile.BadZipfile('truncated data of %s' % info.filename)
+                    fp.seek(position)
+                    fp.write(block)
+                    offset += len(block)
+                    position += len(block)
+
+            fp.seek(0)
+            fp.write(new_info.FileHeader(False))
+            fp.write(data)
+
+            zip_file.filelist = [new_info] + [info for info in zip_file.filelist if info is not old_info]
+            zip_file.NameToInfo[name] = new_info
+            fp.seek(position)
+            zip_file._didModify = True
+            zip_file.close()
+            fp.truncate()
         except:
-            magick_image = PythonMagick.Image(path + '[0]')
-            magick_image.write(path)
-            image = Image.open(path).convert('RGB')
-        width = image.size[0]
-        if width > 600:
-            new_width = 500
-            new_height = int(float(new_width) * image.size[1] / width)
-            image.thumbnail((new_width, new_height), Image.ANTIALIAS)
-        ImageFile.MAXBLOCK = image.size[0] * image.size[1]
-        image.save(path, 'JPEG', optimize=True, progressive=True)
+            __restore_regions(fp, backup, size, chunk_size)
+            os.remove(backup)
+            raise
+    os.remove(backup)
+    return True
+
+def __backup_regions(fp, regions, backup_dir, chunk_size):
+    '''
+    returns name of the file containing (offset, length) header
+    and the data of every region
+    '''
+    handle, backup = tempfile.mkstemp(dir=backup_dir, suffix='.backup')
+    with os.fdopen(handle, 'wb') as ostream:
+        for start, end in regions:
+            ostream.write(struct.pack('<QQ', start, end - start))
+            fp.seek(start)
+            while start < end:
+                block = fp.read(min(end - start, chunk_size))
+                if not block:
+                    raise zipfile.BadZipfile('unexpected end of archive')
+                ostream.write(block)
+                start += len(block)
+        ostream.flush()
+        os.fsync(ostream.fileno())
+    return backup
+
+def __restore_regions(fp, backup, size, chunk_size):
+    with open(backup, 'rb') as istream:
+        while True:
+            header = istream.read(16)
+            if not header:
+                break
+            start, length = struct.unpack('<QQ', header)
+            fp.seek(start)
+            while length > 0:
+                block = istream.read(min(length, chunk_size))
+                fp.write(block)
+                length -= len(block)
+    fp.truncate(size)
+
+def minify_cover(path):
+    try:
+        with open(path, 'rb') as istream:
+            cover = CoverImage.decode(istream.read())
+        if cover:
+            with open(path, 'wb') as ostream:
+                ostream.write(cover.jpeg())
     except:
         pass
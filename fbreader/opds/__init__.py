@@ -1,19 +1,32 @@
-import hashlib, re, shutil, tempfile, urllib2
+import collections, hashlib, itertools, multiprocessing, os, re, shutil, tempfile, threading
 from abc import abstractmethod, ABCMeta
 from datetime import datetime
 from lxml import etree
-from PIL import Image
+from multiprocessing.pool import ThreadPool
 
-from fbreader.format import create_bookfile, detect_mime
+from fbreader.format.util import Verification
+from fbreader.opds.cache import MetadataCache
+from fbreader.opds.feed import FeedWriter
+from fbreader.opds.fetch import Fetcher, HTTPTransport, Transport
+from fbreader.opds.ingest import BookIngester, ingest
+from fbreader.opds.store import CoverStore
 
 NS_ATOM         = 'http://www.w3.org/2005/Atom'
 NS_DUBLIN_CORE  = 'http://purl.org/dc/terms/'
 NS_CALIBRE      = 'http://calibre.kovidgoyal.net/2009/metadata'
 
+NAMESPACES = {
+    None      :   NS_ATOM,
+    'dc'      :   NS_DUBLIN_CORE,
+    'calibre' :   NS_CALIBRE
+}
+
 REL_ACQ_OPEN_ACCESS = 'http://opds-spec.org/acquisition/open-access'
 REL_COVER = 'http://opds-spec.org/cover'
 REL_THUMBNAIL = 'http://opds-spec.org/thumbnail'
 
+CACHE_FILE_NAME = '.cache.sqlite'
+
 class ErrorHandler(object):
     __metaclass__ = ABCMeta
 
@@ -26,33 +39,117 @@ class ErrorHandler(object):
         pass
 
 class OpdsBuilder(object):
-    def __init__(self, output_dir, error_handler):
+    def __init__(self, output_dir, error_handler, workers=1, incremental=False, page_size=0, verification=Verification.FULL, cover_store=None, downloads=4, connections_per_host=2, transport=None):
+        '''
+        workers:        number of processes used for book ingestion
+                        (parsing, cover processing); 1 means all the books
+                        are processed in the calling process
+        incremental:    keep per-url metadata cache in the output directory;
+                        books not changed since the previous build are
+                        neither parsed nor re-downloaded (if the server
+                        supports conditional requests)
+        page_size:      number of books per catalog page; 0 means the whole
+                        catalog is written into single catalog.xml file
+        verification:   zip archive check level for downloaded books,
+                        see fbreader.format.util.Verification
+        cover_store:    CoverStore shared between catalogs, see
+                        fbreader.opds.store; None means covers are
+                        processed for every catalog separately
+        downloads:      number of threads downloading books ahead of
+                        ingestion; 0 means every book is downloaded
+                        by the ingestion worker
+        connections_per_host:
+                        maximum number of simultaneous requests to a host
+        transport:      fbreader.opds.fetch.Transport for book downloads,
+                        HTTPTransport (keep-alive connections) by default
+        '''
         self.__output_dir = output_dir
         self.__error_handler = error_handler
-        
+        self.__workers = workers
+        self.__incremental = incremental
+        self.__page_size = page_size
+        self.__verification = verification
+        self.__cover_store = cover_store
+        self.__downloads = downloads
+        self.__connections_per_host = connections_per_host
+        self.__transport = transport
+
     def build(self, description_file):
         self.__working_dir = tempfile.mkdtemp(dir=self.__output_dir)
+        self.__cache = None
         try:
+            if self.__incremental:
+                self.__cache = MetadataCache(os.path.join(self.__output_dir, CACHE_FILE_NAME))
             self.__build(description_file)
         finally:
+            if self.__cache:
+                self.__cache.close()
             shutil.rmtree(self.__working_dir)
 
     def __build(self, description_file):
+        catalog_info, books = self.__read_description(description_file)
+
+        header = etree.Element(etree.QName(NS_ATOM, 'feed'), nsmap=NAMESPACES)
+        if catalog_info:
+            self.__add_info(header, catalog_info)
+
+        page_size = self.__page_size or max(len(books), 1)
+        page_count = max((len(books) + page_size - 1) // page_size, 1)
+        writer = FeedWriter(self.__working_dir, header, page_count)
+
+        fetcher = Fetcher(self.__transport, self.__connections_per_host)
+        ingester = BookIngester(self.__output_dir, self.__working_dir, self.__verification, self.__cover_store, fetcher)
+        # cache is not accessed from the other threads
+        records = [self.__cached_records(info) for info in books]
+        self.__referenced_files = set()
+        known_files = self.__cache.files() if self.__cache else set()
+        download_pool = None
+        self.__prefetch_slots = None
+        if self.__downloads > 0:
+            download_pool = ThreadPool(self.__downloads)
+            # bounds number of downloaded books waiting for ingestion
+            self.__prefetch_slots = threading.Semaphore(2 * self.__downloads + self.__workers)
+        tasks = self.__tasks(ingester, books, records, download_pool)
+        try:
+            if self.__workers > 1 and len(books) > 1:
+                pool = multiprocessing.Pool(self.__workers)
+                try:
+                    # imap keeps results in the order of the description file
+                    self.__write_pages(writer, page_count, page_size, books, pool.imap(ingest, tasks))
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                self.__write_pages(writer, page_count, page_size, books, itertools.imap(ingest, tasks))
+        finally:
+            if download_pool:
+                download_pool.terminate()
+                download_pool.join()
+            fetcher.close()
+        if self.__cache:
+            self.__prune_cache(books, known_files)
+        if self.__cover_store:
+            self.__cover_store.evict()
+
+        PAGE_PATTERN = re.compile('^catalog-(\d+)\.xml$')
+        for name in os.listdir(self.__output_dir):
+            matcher = PAGE_PATTERN.match(name)
+            if matcher and int(matcher.group(1)) > page_count:
+                os.remove(os.path.join(self.__output_dir, name))
+        for number in range(1, page_count + 1):
+            name = writer.page_name(number)
+            shutil.move(os.path.join(self.__working_dir, name), os.path.join(self.__output_dir, name))
+
+    def __read_description(self, description_file):
         SECTION_PATTERN = re.compile('^\[(.+)\]$')
         section = None
 
-        namespaces = {
-            None      :   NS_ATOM,
-            'dc'      :   NS_DUBLIN_CORE,
-            'calibre' :   NS_CALIBRE
-        }
-        root = etree.Element(etree.QName(NS_ATOM, 'feed'), nsmap=namespaces)
+        catalog_info = {}
+        books = []
         with open(description_file) as data:
-            catalog_info = {}
-            book_info = {
-                'urls': []
-            }
-
             for count, line in enumerate([l.strip() for l in data]):
                 if not line or line.startswith('#'):
                     continue
@@ -68,14 +165,10 @@ class OpdsBuilder(object):
                         elif new_section != 'book':
                             self.__error_handler.fatal('line %s: unknown [%s] section', count + 1, new_section)
                     section = new_section
-                    if catalog_info:
-                        self.__add_info(root, catalog_info)
-                        catalog_info = {}
-                    if book_info['urls']:
-                        self.__add_entry(root, book_info)
-                        book_info = {
+                    if section == 'book':
+                        books.append({
                             'urls': []
-                        }
+                        })
                 else:
                     index = line.find('=')
                     if index <= 0:
@@ -86,49 +179,90 @@ class OpdsBuilder(object):
                         catalog_info[key] = OpdsBuilder.__utf8(value)
                     elif section == 'book':
                         if key == 'url':
-                            book_info['urls'].append(value)
+                            books[-1]['urls'].append(value)
                         else:
-                            book_info[key] = value
-            if book_info['urls']:
-                self.__add_entry(root, book_info)
-        with open(self.__output_dir + '/catalog.xml', 'w') as pfile:
-            etree.ElementTree(root).write(pfile, encoding='utf-8', xml_declaration=True, pretty_print=True)
-
-    def __add_entry(self, root, info):
-        book_map = {}
-        for count, u in enumerate(info['urls']):
-            file_name = self.__working_dir + '/%s' % count
-            try:
-                with open(file_name, 'wb') as f:
-                    request = urllib2.Request(u, headers={ 'User-Agent': 'FBReader.ORG OPDS creator' })
-                    f.write(urllib2.urlopen(request).read())
-                try:
-                    book_map[u] = create_bookfile(file_name, u)
-                except:
-                    self.__error_handler.warning('cannot parse file %s, skipping', u)
-            except:
-                self.__error_handler.warning('cannot download %s, skipping', u)
-        if not book_map:
+                            books[-1][key] = value
+        return (catalog_info, [info for info in books if info['urls']])
+
+    def __cached_records(self, info):
+        records = {}
+        if self.__cache:
+            for u in info['urls']:
+                record = self.__cache.get(u)
+                if record:
+                    records[u] = record
+        return records
+
+    def __tasks(self, ingester, books, records, download_pool):
+        '''
+        yields ingestion tasks; if download pool is provided, books
+        are downloaded in advance, in parallel
+        '''
+        if not download_pool:
+            for info, cached in itertools.izip(books, records):
+                yield (ingester, info, cached, None)
             return
+        pending = collections.deque()
+        for info, cached in itertools.izip(books, records):
+            self.__prefetch_slots.acquire()
+            pending.append((info, cached, download_pool.apply_async(ingester.prefetch, (info, cached))))
+            # keep downloads going while the first book is not ready
+            while pending and (pending[0][2].ready() or len(pending) >= self.__downloads):
+                info, cached, result = pending.popleft()
+                yield (ingester, info, cached, result.get())
+        while pending:
+            info, cached, result = pending.popleft()
+            yield (ingester, info, cached, result.get())
 
-        for u in info['urls']:
-            if book_map.has_key(u):
-                book = book_map.get(u)
-                break
-        book_id = OpdsBuilder.__file_hash(book.path)
+    def __write_pages(self, writer, page_count, page_size, books, results):
+        entries = self.__entries(books, results)
+        for number in range(1, page_count + 1):
+            page_entries = itertools.islice(entries, page_size)
+            writer.write_page(number, (e for e in page_entries if e is not None))
 
-        entry = etree.SubElement(root, etree.QName(NS_ATOM, 'entry'))
-        etree.SubElement(entry, etree.QName(NS_ATOM, 'id')).text = 'book:id:%s' % book_id
+    def __entries(self, books, results):
+        '''
+        yields entry element for each book (None if the book is skipped)
+        '''
+        for count, (info, (entry, records, warnings)) in enumerate(itertools.izip(books, results)):
+            if self.__prefetch_slots:
+                self.__prefetch_slots.release()
+            for pattern, params in warnings:
+                self.__error_handler.warning(pattern, *params)
+            if entry:
+                for key in ('cover', 'thumbnail'):
+                    if entry[key]:
+                        self.__referenced_files.add(entry[key][0])
+            if self.__cache:
+                for u, record in records.items():
+                    self.__cache.put(u, record)
+                if count % 100 == 99:
+                    self.__cache.commit()
+            yield self.__create_entry(info, entry) if entry else None
+
+    def __prune_cache(self, books, known_files):
+        urls = set(u for info in books for u in info['urls'])
+        for u in self.__cache.urls():
+            if not u in urls:
+                self.__cache.remove(u)
+        for name in (known_files | self.__cache.files()) - self.__referenced_files:
+            path = os.path.join(self.__output_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __create_entry(self, info, book):
+        entry = etree.Element(etree.QName(NS_ATOM, 'entry'), nsmap=NAMESPACES)
+        etree.SubElement(entry, etree.QName(NS_ATOM, 'id')).text = 'book:id:%s' % book['id']
         # TODO: use real update time
         etree.SubElement(entry, etree.QName(NS_ATOM, 'updated')).text = OpdsBuilder.__timestamp()
-        etree.SubElement(entry, etree.QName(NS_ATOM, 'title')).text = OpdsBuilder.__utf8(book.title)
-        if book.language_code:
-            etree.SubElement(entry, etree.QName(NS_DUBLIN_CORE, 'language')).text = book.language_code
-        if book.series_info:
-            title = book.series_info.get('title')
+        etree.SubElement(entry, etree.QName(NS_ATOM, 'title')).text = OpdsBuilder.__utf8(book['title'])
+        if book['language_code']:
+            etree.SubElement(entry, etree.QName(NS_DUBLIN_CORE, 'language')).text = book['language_code']
+        if book['series_info']:
+            title = book['series_info'].get('title')
             if title:
                 etree.SubElement(entry, etree.QName(NS_CALIBRE, 'series')).text = OpdsBuilder.__utf8(title)
-            index = book.series_info.get('index')
+            index = book['series_info'].get('index')
             if index:
                 etree.SubElement(entry, etree.QName(NS_CALIBRE, 'series_index')).text = index
 
@@ -138,45 +272,28 @@ class OpdsBuilder(object):
         else:
             if info.get('summary_prefix'):
                 summary += '<p>' + OpdsBuilder.__utf8(info['summary_prefix']) + '</p>'
-            if book.description:
-                summary += OpdsBuilder.__utf8(book.description)
+            if book['description']:
+                summary += OpdsBuilder.__utf8(book['description'])
             if info.get('summary_postfix'):
                 summary += '<p>' + OpdsBuilder.__utf8(info['summary_postfix']) + '</p>'
         if summary:
             etree.SubElement(entry, etree.QName(NS_ATOM, 'summary'), type='html').text = summary
 
-        for name in [author.get('name') for author in book.authors]:
+        for name in book['authors']:
             a = etree.SubElement(entry, etree.QName(NS_ATOM, 'author'))
             etree.SubElement(a, etree.QName(NS_ATOM, 'name')).text = OpdsBuilder.__utf8(name)
             etree.SubElement(a, etree.QName(NS_ATOM, 'uri')).text = 'author:id:' + OpdsBuilder.__string_hash(name)
-        for tag in book.tags:
+        for tag in book['tags']:
             etree.SubElement(entry, etree.QName(NS_ATOM, 'category'), term=tag, label=tag)
-        cover = book.extract_cover(self.__working_dir)
-        if cover:
-            try:
-                path = self.__working_dir + '/' + cover
-                image = Image.open(path).convert('RGB')
-                mime = detect_mime(path)
-                ext = mime[6:] if len(mime) > 7 and mime.startswith('image/') else 'jpeg'
-                url = book_id + '.' + ext
-                shutil.copy(path, self.__output_dir + '/' + url)
-                etree.SubElement(entry, etree.QName(NS_ATOM, 'link'), href=url, type=mime, rel=REL_COVER)
-                if image.size[0] > 160:
-                    width = 128
-                    height = int(float(width) * image.size[1] / image.size[0] + .5)
-                    image.thumbnail((width, height), Image.ANTIALIAS)
-                    thumbnail_path = self.__working_dir + '/thumbnail.jpeg'
-                    image.save(thumbnail_path, 'JPEG')
-                    mime = 'image/jpeg'
-                    url = book_id + '.thumbnail.jpeg'
-                    shutil.copy(thumbnail_path, self.__output_dir + '/' + url)
-                etree.SubElement(entry, etree.QName(NS_ATOM, 'link'), href=url, type=mime, rel=REL_THUMBNAIL)
-            except:
-                pass
-        for u in info['urls']:
-            b = book_map.get(u)
-            if b:
-                etree.SubElement(entry, etree.QName(NS_ATOM, 'link'), href=OpdsBuilder.__utf8(u), type=b.mimetype, rel=REL_ACQ_OPEN_ACCESS)
+        if book['cover']:
+            url, mime = book['cover']
+            etree.SubElement(entry, etree.QName(NS_ATOM, 'link'), href=url, type=mime, rel=REL_COVER)
+        if book['thumbnail']:
+            url, mime = book['thumbnail']
+            etree.SubElement(entry, etree.QName(NS_ATOM, 'link'), href=url, type=mime, rel=REL_THUMBNAIL)
+        for u, mimetype in book['links']:
+            etree.SubElement(entry, etree.QName(NS_ATOM, 'link'), href=OpdsBuilder.__utf8(u), type=mimetype, rel=REL_ACQ_OPEN_ACCESS)
+        return entry
 
     def __add_info(self, root, info):
         etree.SubElement(root, etree.QName(NS_ATOM, 'updated')).text = OpdsBuilder.__timestamp()
@@ -203,16 +320,6 @@ class OpdsBuilder(object):
     def __timestamp():
         return datetime.now().replace(microsecond=0).isoformat()
 
-    @staticmethod
-    def __file_hash(file_name):
-        sha = hashlib.sha1()
-        with open(file_name, 'rb') as istream:
-            data = istream.read(8192)
-            while data:
-                sha.update(data)
-                data = istream.read(8192)
-        return sha.hexdigest()
-
     @staticmethod
     def __string_hash(string):
         sha = hashlib.sha1()
@@ -0,0 +1,75 @@
+import json, sqlite3
+
+class MetadataCache(object):
+    '''
+    Persistent per-url storage for incremental catalog builds.
+    A record is a dict with keys
+        etag, last_modified:    HTTP validators of the last download
+        sha1:                   content hash of the downloaded file
+        mimetype:               detected book mimetype
+        book:                   metadata extracted from the file
+        cover, thumbnail:       (href, mimetype) pairs of the files created
+                                in the output directory; present only if
+                                the cover was processed for this url
+    '''
+    def __init__(self, path):
+        self.__connection = sqlite3.connect(path)
+        self.__connection.execute('''
+            CREATE TABLE IF NOT EXISTS books (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                sha1 TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            )
+        ''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def close(self):
+        self.__connection.commit()
+        self.__connection.close()
+
+    def commit(self):
+        self.__connection.commit()
+
+    def get(self, url):
+        row = self.__connection.execute(
+            'SELECT etag, last_modified, sha1, metadata FROM books WHERE url=?', (url,)
+        ).fetchone()
+        if not row:
+            return None
+        record = json.loads(row[3])
+        record['etag'] = row[0]
+        record['last_modified'] = row[1]
+        record['sha1'] = row[2]
+        return record
+
+    def put(self, url, record):
+        metadata = dict((k, v) for k, v in record.items() if k not in ('etag', 'last_modified', 'sha1'))
+        self.__connection.execute(
+            'INSERT OR REPLACE INTO books (url, etag, last_modified, sha1, metadata) VALUES (?, ?, ?, ?, ?)',
+            (url, record.get('etag'), record.get('last_modified'), record['sha1'], json.dumps(metadata))
+        )
+
+    def remove(self, url):
+        self.__connection.execute('DELETE FROM books WHERE url=?', (url,))
+
+    def urls(self):
+        return [row[0] for row in self.__connection.execute('SELECT url FROM books')]
+
+    def files(self):
+        '''
+        returns set of all cover and thumbnail files referenced by records
+        '''
+        result = set()
+        for url in self.urls():
+            record = self.get(url)
+            for key in ('cover', 'thumbnail'):
+                if record.get(key):
+                    result.add(record[key][0])
+        return result
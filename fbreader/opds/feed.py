@@ -0,0 +1,83 @@
+import os
+from lxml import etree
+
+MIME_ACQUISITION_FEED = 'application/atom+xml;profile=opds-catalog;kind=acquisition'
+
+class FeedWriter(object):
+    '''
+    Writes OPDS catalog incrementally, page by page; entries are serialized
+    as soon as they are produced, so the whole feed is never kept in memory.
+    Page 1 is written to <file_name>.xml, page N to <file_name>-N.xml;
+    pages are linked to each other by first/previous/next/last links.
+    '''
+    def __init__(self, directory, header, page_count, file_name='catalog'):
+        '''
+        directory:  directory to create page files in
+        header:     feed element; its children are copied to every page
+        page_count: total number of pages
+        '''
+        self.__directory = directory
+        self.__header = header
+        self.__page_count = page_count
+        self.__file_name = file_name
+
+    def page_name(self, number):
+        if number == 1:
+            return self.__file_name + '.xml'
+        return '%s-%d.xml' % (self.__file_name, number)
+
+    def write_page(self, number, entries):
+        '''
+        number:     page number, 1-based
+        entries:    iterable of entry elements
+        '''
+        path = os.path.join(self.__directory, self.page_name(number))
+        with etree.xmlfile(path, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element(self.__header.tag, nsmap=self.__header.nsmap):
+                for node in self.__header:
+                    self.__write(xf, node, self.__header.nsmap, 1)
+                if self.__page_count > 1:
+                    for node in self.__navigation_links(number):
+                        self.__write(xf, node, self.__header.nsmap, 1)
+                for entry in entries:
+                    self.__write(xf, entry, self.__header.nsmap, 1)
+                xf.write('\n')
+
+    def __write(self, xf, node, parent_nsmap, level=None):
+        '''
+        writes node element by element: elements written with xf.element
+        inherit namespace declarations of the enclosing ones, while
+        xf.write(node) would repeat them on every node
+        level:  indentation level; None for mixed content, that is written as is
+        '''
+        if level is not None:
+            xf.write('\n' + '  ' * level)
+        if isinstance(node.tag, basestring):
+            nsmap = dict((prefix, uri) for prefix, uri in node.nsmap.items() if parent_nsmap.get(prefix) != uri)
+            mixed = bool(node.text and node.text.strip()) or any(child.tail and child.tail.strip() for child in node)
+            child_level = level + 1 if level is not None and not mixed else None
+            with xf.element(node.tag, node.attrib, nsmap=nsmap or None):
+                if node.text and (child_level is None or len(node) == 0):
+                    xf.write(node.text)
+                for child in node:
+                    self.__write(xf, child, node.nsmap, child_level)
+                if child_level is not None and len(node) > 0:
+                    xf.write('\n' + '  ' * level)
+        else:
+            # comment or processing instruction
+            xf.write(node, with_tail=False)
+        if level is None and node.tail:
+            xf.write(node.tail)
+
+    def __navigation_links(self, number):
+        links = [('first', 1), ('last', self.__page_count)]
+        if number > 1:
+            links.append(('previous', number - 1))
+        if number < self.__page_count:
+            links.append(('next', number + 1))
+        tag = etree.QName(etree.QName(self.__header).namespace, 'link')
+        return [
+            etree.Element(tag, nsmap=self.__header.nsmap, href=self.page_name(page), rel=rel, type=MIME_ACQUISITION_FEED)
+            for rel, page in links
+        ]
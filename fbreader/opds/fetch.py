@@ -0,0 +1,263 @@
+import hashlib, httplib, socket, threading, time, urllib2, urlparse
+from abc import abstractmethod, ABCMeta
+
+USER_AGENT = 'FBReader.ORG OPDS creator'
+
+class Transport(object):
+    '''
+    Sends GET requests for Fetcher; replace it to test fetching
+    without network access.
+    '''
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def request(self, url, headers):
+        '''
+        returns response object with
+            status:             HTTP status code (int)
+            getheader(name):    header value or None
+            read(size):         next chunk of the body, '' at the end
+            close():            must be called when the response is not needed
+        raises exception if the request cannot be sent
+        '''
+        pass
+
+class HTTPTransport(Transport):
+    '''
+    Keeps HTTP connections alive and reuses them for subsequent requests
+    to the same host; redirects are followed. Non-HTTP urls (file://, ftp://)
+    are opened with urllib2. Can be used from several threads.
+    '''
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout=60):
+        self.__timeout = timeout
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+    def __getstate__(self):
+        # open connections and locks are not passed to other processes
+        return { 'timeout': self.__timeout }
+
+    def __setstate__(self, state):
+        self.__init__(state['timeout'])
+
+    def request(self, url, headers):
+        for count in range(HTTPTransport.MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                return HTTPTransport.__open_url(url, headers)
+            response = self.__request(parts, headers)
+            location = response.getheader('Location')
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                return response
+            response.close()
+            url = urlparse.urljoin(url, location)
+        raise Exception('Too many redirects')
+
+    def __request(self, parts, headers):
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            connection = self.__idle_connection(key)
+            reused = connection is not None
+            if not reused:
+                if parts.scheme == 'https':
+                    connection = httplib.HTTPSConnection(parts.netloc, timeout=self.__timeout)
+                else:
+                    connection = httplib.HTTPConnection(parts.netloc, timeout=self.__timeout)
+            try:
+                connection.request('GET', path, headers=headers)
+                return PooledResponse(connection.getresponse(), connection, self, key)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # the server has closed idle connection, try a new one
+                if not reused:
+                    raise
+
+    def __idle_connection(self, key):
+        with self.__lock:
+            connections = self.__idle.get(key)
+            return connections.pop() if connections else None
+
+    def release(self, key, connection):
+        with self.__lock:
+            self.__idle.setdefault(key, []).append(connection)
+
+    def close(self):
+        with self.__lock:
+            for connections in self.__idle.values():
+                for connection in connections:
+                    connection.close()
+            self.__idle = {}
+
+    @staticmethod
+    def __open_url(url, headers):
+        try:
+            return URLResponse(urllib2.urlopen(urllib2.Request(url, headers=headers)))
+        except urllib2.HTTPError, error:
+            return URLResponse(error)
+
+class PooledResponse(object):
+    '''
+    Response of HTTPTransport; connection is returned to the pool on close()
+    if the server keeps it alive and the body has been read completely
+    '''
+    def __init__(self, response, connection, transport, key):
+        self.__response = response
+        self.__connection = connection
+        self.__transport = transport
+        self.__key = key
+        self.status = response.status
+
+    def getheader(self, name):
+        return self.__response.getheader(name)
+
+    def read(self, size):
+        return self.__response.read(size)
+
+    def close(self):
+        if self.__connection is None:
+            return
+        try:
+            # empty (304, redirect) and small unread bodies do not
+            # prevent the connection from being reused
+            length = self.__response.length
+            if not self.__response.isclosed() and length is not None and length <= Fetcher.CHUNK_SIZE:
+                self.__response.read()
+        except (httplib.HTTPException, socket.error):
+            pass
+        if self.__response.isclosed() and not self.__response.will_close:
+            self.__transport.release(self.__key, self.__connection)
+        else:
+            self.__connection.close()
+        self.__connection = None
+
+class URLResponse(object):
+    '''
+    urllib2 response (or HTTPError) in Transport response interface
+    '''
+    def __init__(self, response):
+        self.__response = response
+        self.status = getattr(response, 'code', None) or 200
+
+    def getheader(self, name):
+        return self.__response.info().getheader(name)
+
+    def read(self, size):
+        return self.__response.read(size)
+
+    def close(self):
+        self.__response.close()
+
+class Fetcher(object):
+    '''
+    Downloads books for BookIngester: conditional requests for cached
+    records, bodies streamed to disk, transient errors retried.
+    Can be shared by several threads; number of simultaneous requests
+    to a host is limited.
+    '''
+    CHUNK_SIZE = 65536
+    # statuses worth to retry the request for
+    TRANSIENT = (408, 429, 500, 502, 503, 504)
+
+    class TransientError(Exception):
+        pass
+
+    def __init__(self, transport=None, connections_per_host=2, retries=3, backoff=1.0):
+        '''
+        transport:              Transport instance, HTTPTransport by default
+        connections_per_host:   maximum number of simultaneous requests to a host
+        retries:                number of additional attempts after a network
+                                error or a transient error status
+        backoff:                delay before the first retry, in seconds;
+                                doubled for each next one
+        '''
+        self.__transport = transport or HTTPTransport()
+        self.__connections_per_host = connections_per_host
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__semaphores = {}
+        self.__lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_Fetcher__semaphores']
+        del state['_Fetcher__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__semaphores = {}
+        self.__lock = threading.Lock()
+
+    def fetch(self, url, file_name, cached=None):
+        '''
+        url:        book url
+        file_name:  file to write the book to
+        cached:     record of the previous download, see MetadataCache
+        returns cached record if the url content is not changed,
+        new record with validators and content hash otherwise
+        '''
+        headers = { 'User-Agent': USER_AGENT }
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        semaphore = self.__host_semaphore(url)
+        attempt = 0
+        while True:
+            try:
+                with semaphore:
+                    return self.__fetch(url, headers, file_name, cached)
+            except (Fetcher.TransientError, httplib.HTTPException, socket.error):
+                if attempt >= self.__retries:
+                    raise
+            time.sleep(self.__backoff * 2 ** attempt)
+            attempt += 1
+
+    def __fetch(self, url, headers, file_name, cached):
+        response = self.__transport.request(url, headers)
+        try:
+            if cached and response.status == 304:
+                return cached
+            if response.status in Fetcher.TRANSIENT:
+                raise Fetcher.TransientError('HTTP error %s' % response.status)
+            if response.status != 200:
+                raise Exception('HTTP error %s' % response.status)
+            etag = response.getheader('ETag')
+            last_modified = response.getheader('Last-Modified')
+            # some servers (and file:// urls) ignore conditional requests
+            if cached and (etag or last_modified) and \
+                    etag == cached.get('etag') and last_modified == cached.get('last_modified'):
+                return cached
+            sha = hashlib.sha1()
+            with open(file_name, 'wb') as ostream:
+                data = response.read(Fetcher.CHUNK_SIZE)
+                while data:
+                    sha.update(data)
+                    ostream.write(data)
+                    data = response.read(Fetcher.CHUNK_SIZE)
+            return {
+                'etag': etag,
+                'last_modified': last_modified,
+                'sha1': sha.hexdigest()
+            }
+        finally:
+            response.close()
+
+    def __host_semaphore(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self.__lock:
+            semaphore = self.__semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.__connections_per_host)
+                self.__semaphores[host] = semaphore
+            return semaphore
+
+    def close(self):
+        if isinstance(self.__transport, HTTPTransport):
+            self.__transport.close()
@@ -0,0 +1,236 @@
+import os, shutil, tempfile
+
+from fbreader.format import create_bookfile
+from fbreader.format.cover import CoverImage
+from fbreader.format.mimetype import Mimetype
+from fbreader.format.util import Verification
+from fbreader.opds.fetch import Fetcher
+
+def ingest(task):
+    '''
+    task:   (BookIngester, book info, cached records, prefetched files) tuple;
+            module-level function to be usable with multiprocessing pools
+    '''
+    ingester, info, records, prefetched = task
+    return ingester.ingest(info, records, prefetched)
+
+class BookIngester(object):
+    '''
+    Downloads, parses and processes covers for a single catalog entry.
+    Holds no open resources, so it can be passed to worker processes.
+    '''
+    THUMBNAIL_WIDTH = 128
+    # covers not wider than this are used as thumbnails
+    THUMBNAIL_MIN_WIDTH = 160
+
+    def __init__(self, output_dir, working_dir, verification=Verification.FULL, cover_store=None, fetcher=None):
+        '''
+        cover_store:    CoverStore shared between catalogs; stored covers
+                        are linked into the output directory instead
+                        of being extracted and resized again
+        fetcher:        Fetcher used for urls not downloaded in advance
+        '''
+        self.__output_dir = output_dir
+        self.__working_dir = working_dir
+        self.__verification = verification
+        self.__cover_store = cover_store
+        self.__fetcher = fetcher or Fetcher()
+
+    def prefetch(self, info, records=None):
+        '''
+        downloads all the book urls; can be called from several threads
+        sharing the same fetcher
+        returns (working directory, downloads) pair to be passed to ingest();
+        downloads is url => record map, None for urls failed to download
+        '''
+        records = records or {}
+        working_dir = tempfile.mkdtemp(dir=self.__working_dir)
+        downloads = {}
+        for count, u in enumerate(info['urls']):
+            try:
+                downloads[u] = self.__fetcher.fetch(u, working_dir + '/%s' % count, records.get(u))
+            except:
+                downloads[u] = None
+        return (working_dir, downloads)
+
+    def ingest(self, info, records=None, prefetched=None):
+        '''
+        info:       book section of catalog description
+        records:    url => record map of cached data from previous builds
+                    (see MetadataCache for the record format)
+        prefetched: result of prefetch() for the same info and records;
+                    None means urls are downloaded here
+        returns (entry, records, warnings) triple; entry is None if none
+        of the urls can be used, records is url => record map of up-to-date
+        data for all successfully processed urls, warnings is a list
+        of (pattern, params) pairs
+        '''
+        warnings = []
+        if prefetched:
+            working_dir, downloads = prefetched
+        else:
+            working_dir, downloads = tempfile.mkdtemp(dir=self.__working_dir), None
+        try:
+            entry, records = self.__ingest(info, records or {}, working_dir, downloads, warnings)
+            return (entry, records, warnings)
+        finally:
+            shutil.rmtree(working_dir)
+
+    def __ingest(self, info, cached_records, working_dir, downloads, warnings):
+        book_map = {}
+        records = {}
+        try:
+            for count, u in enumerate(info['urls']):
+                file_name = working_dir + '/%s' % count
+                cached = cached_records.get(u)
+                try:
+                    if downloads is None:
+                        record = self.__fetcher.fetch(u, file_name, cached)
+                    else:
+                        record = downloads[u]
+                        if record is None:
+                            raise Exception('download failed')
+                except:
+                    warnings.append(('cannot download %s, skipping', (u,)))
+                    continue
+                if cached and record is not cached and record['sha1'] == cached['sha1']:
+                    cached.update(record)
+                    record = cached
+                if record is cached:
+                    records[u] = record
+                    continue
+                try:
+                    book = create_bookfile(file_name, u, self.__verification)
+                except:
+                    warnings.append(('cannot parse file %s, skipping', (u,)))
+                    continue
+                book_map[u] = book
+                record['mimetype'] = book.mimetype
+                record['book'] = {
+                    'title': book.title,
+                    'language_code': book.language_code,
+                    'series_info': book.series_info,
+                    'description': book.description,
+                    'authors': [author.get('name') for author in book.authors],
+                    'tags': book.tags
+                }
+                records[u] = record
+            if not records:
+                return (None, records)
+
+            for count, u in enumerate(info['urls']):
+                if records.has_key(u):
+                    record = records[u]
+                    break
+            book_id = record['sha1']
+            if not self.__has_cover_files(record) and not self.__link_stored_cover(book_id, record):
+                book = book_map.get(u)
+                if not book:
+                    file_name = working_dir + '/%s' % count
+                    try:
+                        if not os.path.exists(file_name):
+                            self.__fetcher.fetch(u, file_name)
+                        book = create_bookfile(file_name, u, self.__verification)
+                        book_map[u] = book
+                    except:
+                        book = None
+                if book:
+                    self.__process_cover(book, book_id, record)
+
+            entry = dict(record['book'])
+            entry['id'] = book_id
+            entry['cover'] = record.get('cover')
+            entry['thumbnail'] = record.get('thumbnail')
+            entry['links'] = [(u, records[u]['mimetype']) for u in info['urls'] if records.has_key(u)]
+            return (entry, records)
+        finally:
+            for book in book_map.values():
+                book.__exit__(None, None, None)
+
+    def __has_cover_files(self, record):
+        if not record.has_key('cover'):
+            return False
+        for key in ('cover', 'thumbnail'):
+            if record[key] and not os.path.exists(os.path.join(self.__output_dir, record[key][0])):
+                return False
+        return True
+
+    def __store_key(self, book_id):
+        return self.__cover_store.key(
+            book_id,
+            CoverImage.MAX_WIDTH,
+            CoverImage.WIDTH,
+            BookIngester.THUMBNAIL_MIN_WIDTH,
+            BookIngester.THUMBNAIL_WIDTH
+        )
+
+    def __link_stored_cover(self, book_id, record):
+        '''
+        returns True if the cover store has an entry for the book;
+        its files are linked into the output directory
+        '''
+        if not self.__cover_store:
+            return False
+        stored = self.__cover_store.get(self.__store_key(book_id))
+        if not stored:
+            return False
+        try:
+            self.__set_cover_files(book_id, record, *stored)
+            return True
+        except:
+            # evicted by a concurrent build
+            return False
+
+    def __process_cover(self, book, book_id, record):
+        '''
+        cover is decoded once, in memory; cover and thumbnail
+        files are written directly to the output directory,
+        or put into the cover store and linked from there
+        '''
+        record['cover'] = None
+        record['thumbnail'] = None
+        try:
+            cover = book.extract_cover_image()
+            if not cover:
+                if self.__cover_store:
+                    self.__cover_store.put(self.__store_key(book_id), None)
+                return
+            cover_data = cover.jpeg()
+            thumbnail_data = None
+            if cover.size[0] > BookIngester.THUMBNAIL_MIN_WIDTH:
+                thumbnail_data = cover.thumbnail_jpeg(BookIngester.THUMBNAIL_WIDTH)
+            if self.__cover_store:
+                stored = self.__cover_store.put(self.__store_key(book_id), cover_data, thumbnail_data)
+                self.__set_cover_files(book_id, record, *stored)
+                return
+            url = book_id + '.jpeg'
+            self.__write_output_file(url, cover_data)
+            record['cover'] = (url, Mimetype.JPEG)
+            if thumbnail_data is not None:
+                url = book_id + '.thumbnail.jpeg'
+                self.__write_output_file(url, thumbnail_data)
+            record['thumbnail'] = (url, Mimetype.JPEG)
+        except:
+            pass
+
+    def __set_cover_files(self, book_id, record, cover_path, thumbnail_path):
+        '''
+        links stored files into the output directory
+        and sets record cover and thumbnail
+        '''
+        record['cover'] = None
+        record['thumbnail'] = None
+        if not cover_path:
+            return
+        url = book_id + '.jpeg'
+        self.__cover_store.link(cover_path, os.path.join(self.__output_dir, url))
+        cover = (url, Mimetype.JPEG)
+        if thumbnail_path:
+            url = book_id + '.thumbnail.jpeg'
+            self.__cover_store.link(thumbnail_path, os.path.join(self.__output_dir, url))
+        record['cover'] = cover
+        record['thumbnail'] = (url, Mimetype.JPEG)
+
+    def __write_output_file(self, name, data):
+        with open(os.path.join(self.__output_dir, name), 'wb') as ostream:
+            ostream.write(data)
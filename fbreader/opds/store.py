@@ -0,0 +1,148 @@
+import os, shutil
+
+class CoverStore(object):
+    '''
+    Content-addressed storage of processed covers, shared between
+    catalogs. An entry is identified by a key built from the book
+    content hash and the cover processing parameters, and consists of
+        <key>.jpeg              minified cover
+        <key>.thumbnail.jpeg    thumbnail; absent if the cover is small
+                                enough to be used as a thumbnail
+        <key>.none              marker file for books without a cover
+    Files are linked into catalog output directories (copied if linking
+    is not possible). Entry modification time is updated on every use;
+    evict() removes least recently used entries when the total size of
+    the store exceeds the limit.
+    '''
+    COVER = '.jpeg'
+    THUMBNAIL = '.thumbnail.jpeg'
+    NONE = '.none'
+
+    def __init__(self, directory, size_limit=0):
+        '''
+        directory:  store location; created if it does not exist
+        size_limit: maximum total size of the stored files, in bytes;
+                    0 means no limit
+        '''
+        self.__directory = directory
+        self.__size_limit = size_limit
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(book_id, *params):
+        '''
+        book_id:    content hash of the book file
+        params:     cover processing parameters (numbers or strings)
+        '''
+        return '-'.join([book_id] + [str(p) for p in params])
+
+    def get(self, key):
+        '''
+        returns None if there is no entry for the key,
+        (cover path, thumbnail path) pair otherwise; both paths are None
+        for a book without a cover, thumbnail path is None if the cover
+        is used as a thumbnail
+        '''
+        base = self.__base(key)
+        try:
+            if os.path.exists(base + CoverStore.NONE):
+                os.utime(base + CoverStore.NONE, None)
+                return (None, None)
+            os.utime(base + CoverStore.COVER, None)
+        except OSError:
+            return None
+        thumbnail = base + CoverStore.THUMBNAIL
+        if os.path.exists(thumbnail):
+            os.utime(thumbnail, None)
+            return (base + CoverStore.COVER, thumbnail)
+        return (base + CoverStore.COVER, None)
+
+    def put(self, key, cover_data, thumbnail_data=None):
+        '''
+        cover_data:     encoded cover, None if the book has no cover
+        thumbnail_data: encoded thumbnail, None if the cover is used
+                        as a thumbnail
+        returns the same pair as get()
+        '''
+        base = self.__base(key)
+        directory = os.path.dirname(base)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process
+                pass
+        if cover_data is None:
+            CoverStore.__write(base + CoverStore.NONE, '')
+            return (None, None)
+        # thumbnail goes first: an entry is complete once the cover exists
+        if thumbnail_data is not None:
+            CoverStore.__write(base + CoverStore.THUMBNAIL, thumbnail_data)
+        CoverStore.__write(base + CoverStore.COVER, cover_data)
+        return (base + CoverStore.COVER, base + CoverStore.THUMBNAIL if thumbnail_data is not None else None)
+
+    @staticmethod
+    def link(path, target):
+        '''
+        makes the stored file available as target; existing target is replaced
+        '''
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.link(path, target)
+        except OSError:
+            # different file systems or no hard link support
+            shutil.copyfile(path, target)
+
+    def evict(self):
+        '''
+        removes least recently used entries until the total size
+        of the store fits the limit
+        '''
+        if self.__size_limit <= 0:
+            return
+        entries = {}
+        total = 0
+        for root, dirs, files in os.walk(self.__directory):
+            for name in files:
+                key = CoverStore.__entry_key(name)
+                if key is None:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                mtime, size, paths = entries.get(key, (0, 0, []))
+                paths.append(path)
+                entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size, paths)
+                total += stat.st_size
+        for mtime, size, paths in sorted(entries.values()):
+            if total <= self.__size_limit:
+                break
+            # cover first: entry without a cover file is considered missing
+            for path in sorted(paths, key=lambda p: p.endswith(CoverStore.THUMBNAIL)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def __base(self, key):
+        return os.path.join(self.__directory, key[:2], key)
+
+    @staticmethod
+    def __entry_key(name):
+        for suffix in (CoverStore.THUMBNAIL, CoverStore.COVER, CoverStore.NONE):
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+        return None
+
+    @staticmethod
+    def __write(path, data):
+        # rename is atomic, concurrent readers never see partial files
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp, 'wb') as ostream:
+            ostream.write(data)
+        os.rename(temp, path)
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+import json, sys
+from argparse import ArgumentParser
+
+from fbreader.format.batch import scan_directory
+from fbreader.format.util import Verification
+
+def parse_command_line():
+    parser = ArgumentParser(
+        description='Book metadata scanner: writes one JSON record per file'
+    )
+    parser.add_argument(
+        'directory',
+        help='directory to scan (recursively)'
+    )
+    parser.add_argument(
+        '-o',
+        metavar='output_file',
+        dest='output_file',
+        default=None,
+        help='file to write JSON Lines records to (default = stdout)'
+    )
+    parser.add_argument(
+        '-j',
+        metavar='workers',
+        dest='workers',
+        type=int,
+        default=1,
+        help='number of files to parse in parallel (default = 1)'
+    )
+    parser.add_argument(
+        '--verify',
+        dest='verification',
+        choices=Verification.ALL,
+        default=Verification.FULL,
+        help='zip archive check level: lazy (entries are checked when read), central-directory (no decompression), full (default, all entries are checked)'
+    )
+    params = parser.parse_args(sys.argv[1:])
+    return params
+
+if __name__ == '__main__':
+    params = parse_command_line()
+    ostream = open(params.output_file, 'w') if params.output_file else sys.stdout
+    try:
+        for record in scan_directory(params.directory, workers=params.workers, verification=params.verification):
+            ostream.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        if ostream is not sys.stdout:
+            ostream.close()
@@ -0,0 +1,94 @@
+import os, shutil, tempfile, unittest, zipfile
+
+from fbreader.format.epub import EPub
+from fbreader.format.mimetype import Mimetype
+from fbreader.format.util import store_entry_first
+
+class StoreEntryFirstTest(unittest.TestCase):
+    '''
+    in-place repair of ePub archives with broken mimetype entry
+    '''
+    CONTENT = [
+        ('META-INF/container.xml', '<container/>' * 50),
+        ('OEBPS/content.opf', '<package/>' * 200),
+        ('OEBPS/text.xhtml', 'text ' * 1000)
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'book.epub')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_mimetype_deflated(self):
+        self.__write([(EPub.Entry.MIMETYPE, Mimetype.EPUB, zipfile.ZIP_DEFLATED)] +
+            [(name, data, zipfile.ZIP_DEFLATED) for name, data in StoreEntryFirstTest.CONTENT])
+        self.__check_issue(EPub.Issue.MIMETYPE_ITEM_IS_DEFLATED)
+        self.assertTrue(store_entry_first(self.path, EPub.Entry.MIMETYPE, Mimetype.EPUB, self.directory))
+        self.__check_repaired()
+
+    def test_first_item_not_mimetype(self):
+        self.__write([(name, data, zipfile.ZIP_DEFLATED) for name, data in StoreEntryFirstTest.CONTENT[:2]] +
+            [(EPub.Entry.MIMETYPE, Mimetype.EPUB, zipfile.ZIP_STORED)] +
+            [(name, data, zipfile.ZIP_DEFLATED) for name, data in StoreEntryFirstTest.CONTENT[2:]])
+        self.__check_issue(EPub.Issue.FIRST_ITEM_NOT_MIMETYPE)
+        self.assertTrue(store_entry_first(self.path, EPub.Entry.MIMETYPE, Mimetype.EPUB, self.directory))
+        self.__check_repaired()
+
+    def test_small_archive(self):
+        # archive data is smaller than the new mimetype entry
+        self.__write([
+            (EPub.Entry.MIMETYPE, '', zipfile.ZIP_DEFLATED),
+            ('a', 'a', zipfile.ZIP_STORED)
+        ])
+        self.assertTrue(store_entry_first(self.path, EPub.Entry.MIMETYPE, Mimetype.EPUB, self.directory))
+        with zipfile.ZipFile(self.path) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.read(EPub.Entry.MIMETYPE), Mimetype.EPUB)
+            self.assertEqual(zip_file.read('a'), 'a')
+
+    def test_repair(self):
+        self.__write([(name, data, zipfile.ZIP_DEFLATED) for name, data in StoreEntryFirstTest.CONTENT] +
+            [(EPub.Entry.MIMETYPE, Mimetype.EPUB, zipfile.ZIP_DEFLATED)])
+        book = EPub(self.path, 'book.epub', lazy=True)
+        try:
+            book.repair(self.directory)
+            self.assertEqual(book.issues, [])
+        finally:
+            book.close()
+        self.__check_repaired()
+
+    def __write(self, entries):
+        with zipfile.ZipFile(self.path, 'w') as zip_file:
+            for name, data, compress_type in entries:
+                zip_file.writestr(name, data, compress_type)
+
+    def __check_issue(self, issue):
+        book = EPub(self.path, 'book.epub', lazy=True)
+        try:
+            self.assertEqual(book.issues, [issue])
+        finally:
+            book.close()
+
+    def __check_repaired(self):
+        with open(self.path, 'rb') as istream:
+            head = istream.read(30 + len(EPub.Entry.MIMETYPE) + len(Mimetype.EPUB))
+        self.assertEqual(head[:4], zipfile.stringFileHeader)
+        self.assertEqual(head[30:], EPub.Entry.MIMETYPE + Mimetype.EPUB)
+        book = EPub(self.path, 'book.epub', lazy=True)
+        try:
+            self.assertEqual(book.issues, [])
+        finally:
+            book.close()
+        with zipfile.ZipFile(self.path) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.infolist()[0].filename, EPub.Entry.MIMETYPE)
+            self.assertEqual(zip_file.read(EPub.Entry.MIMETYPE), Mimetype.EPUB)
+            for name, data in StoreEntryFirstTest.CONTENT:
+                self.assertEqual(zip_file.read(name), data)
+        # backup file is removed
+        self.assertEqual(os.listdir(self.directory), ['book.epub'])
+
+if __name__ == '__main__':
+    unittest.main()